@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+""" Benchmarks for DIpy.
+
+Builds synthetic component graphs and measures how quickly they resolve:
+
+    python bench.py                              # print results
+    python bench.py --output results.json        # save results
+    python bench.py --baseline baseline.json     # flag regressions
+
+Every component at one level of the graph depends on every component at the
+next level, so a graph of depth D and fan-out F registers D * F components
+and builds on the order of F ** D instances per resolve. The root component also takes a
+'_list' of plugins and a '_fact' for the leaves, and the levels are spread
+across a chain of nested containers.
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+from timeit import repeat
+from tracemalloc import get_traced_memory, start, stop
+from dipy import Container, container_resolved, getargspec
+
+
+class Widget(object):
+
+    def __init__(self):
+        super(Widget, self).__init__()
+
+
+def unpooled_container_resolved(container):
+    """ container_resolved as it was before request scopes were pooled. """
+    def wrap(f):
+        def call(*args, **kwargs):
+            with Container(parent=container) as request:
+                func_args = getargspec(f)[0]
+                for name in func_args[len(args):]:
+                    if name in kwargs: continue
+                    kwargs[name] = request.resolve(name)
+                return f(*args, **kwargs)
+        return call
+    return wrap
+
+
+def per_call(f, number=100000):
+    return min(repeat(f, number=number, repeat=5)) / number
+
+
+def component(name, args, body=()):
+    # dipy injects constructor arguments by name, so the synthetic components
+    # need real signatures rather than *args
+    lines = ['class %s(object):' % name,
+             '    def __init__(self%s):' % ''.join(', ' + arg for arg in args)]
+    lines.extend('        ' + line for line in body)
+    lines.append('        self.dependencies = (%s)' % ''.join(arg + ', ' for arg in args))
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace[name]
+
+
+def build_graph(depth, fanout, list_width, facts, hierarchy):
+    """ Return a (container, name) pair for a synthetic component graph.
+    Level i is registered in the i-th container from the bottom of the
+    hierarchy, wrapping around when there are more levels than containers.
+    """
+    containers = [Container()]
+    for _ in range(hierarchy - 1):
+        containers.append(Container(parent=containers[-1]))
+    leaf = containers[-1]
+
+    def names(level):
+        return ['node_%d_%d' % (level, i) for i in range(fanout)]
+
+    for level in range(depth):
+        args = names(level + 1) if level + 1 < depth else []
+        container = containers[max(0, len(containers) - 1 - level % hierarchy)]
+        for name in names(level):
+            container.register(name, component(name, args))
+
+    for i in range(list_width):
+        leaf.register('plugin', component('plugin_%d' % i, []))
+
+    args = names(0)
+    body = []
+    if list_width:
+        args.append('plugin_list')
+    if facts:
+        args.append('node_%d_0_fact' % (depth - 1))
+        body.append('for _ in range(%d): node_%d_0_fact()' % (facts, depth - 1))
+    leaf.register('root', component('root', args, body))
+    return leaf, 'root'
+
+
+def bench_resolve(args):
+    container, name = build_graph(args.depth, args.fanout, args.list_width,
+                                  args.facts, args.hierarchy)
+    number = args.number
+    results = {}
+    interpreted = per_call(lambda: container.resolve(name), number)
+    results['resolves_per_sec'] = 1.0 / interpreted
+    container.compile(name)
+    compiled = per_call(lambda: container.resolve(name), number)
+    results['compiled_resolves_per_sec'] = 1.0 / compiled
+    return results
+
+
+def bench_container_resolved(args):
+    c = Container()
+    c.register("widget", Widget)
+
+    def handler(request, widget):
+        return widget
+
+    before = unpooled_container_resolved(c)(handler)
+    after = container_resolved(c)(handler)
+    direct = per_call(lambda: handler(None, Widget()), args.number)
+    results = {}
+    for label, f in (("unpooled", before), ("pooled", after)):
+        overhead = per_call(lambda: f(None), args.number) - direct
+        results['container_resolved_%s_overhead_us' % label] = overhead * 1e6
+    return results
+
+
+def bench_memory(args):
+    start()
+    try:
+        container, name = build_graph(args.depth, args.fanout, args.list_width,
+                                      args.facts, args.hierarchy)
+        for _ in range(args.number):
+            container.resolve(name)
+        peak = get_traced_memory()[1]
+    finally:
+        stop()
+    return {'peak_memory_kb': peak / 1024.0}
+
+
+# Metrics where a smaller value is an improvement; all others are rates
+_LOWER_IS_BETTER = ('_us', '_kb')
+
+
+def regressions(results, baseline, threshold):
+    """ Return (name, baseline, result) for every metric that got worse
+    than the baseline by more than 'threshold' (a fraction).
+    """
+    found = []
+    for key, old in sorted(baseline.get('metrics', {}).items()):
+        new = results['metrics'].get(key)
+        if new is None or not old:
+            continue
+        if key.endswith(_LOWER_IS_BETTER):
+            change = (new - old) / abs(old)
+        else:
+            change = (old - new) / abs(old)
+        if change > threshold:
+            found.append((key, old, new))
+    return found
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark DIpy resolution.")
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--list-width', type=int, default=8)
+    parser.add_argument('--facts', type=int, default=2)
+    parser.add_argument('--hierarchy', type=int, default=3)
+    parser.add_argument('--number', type=int, default=1000,
+                        help="calls per timing run")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--baseline', help="compare results to this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="fractional slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    metrics = {}
+    metrics.update(bench_resolve(args))
+    metrics.update(bench_container_resolved(args))
+    metrics.update(bench_memory(args))
+    results = {
+        'graph': dict((key, getattr(args, key)) for key in
+                      ('depth', 'fanout', 'list_width', 'facts', 'hierarchy')),
+        'metrics': metrics,
+    }
+
+    for key, value in sorted(metrics.items()):
+        print("%-40s %12.2f" % (key, value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('graph') != results['graph']:
+            print("warning: baseline was measured on a different graph")
+        found = regressions(results, baseline, args.threshold)
+        for key, old, new in found:
+            print("REGRESSION %s: %.2f -> %.2f" % (key, old, new))
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
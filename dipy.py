@@ -1,117 +1,1877 @@
 #!/usr/bin/python
 
-from inspect import getargspec
+from asyncio import current_task, ensure_future, gather, get_running_loop, shield, wait_for
+from asyncio import TimeoutError as AsyncTimeoutError
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextvars import ContextVar
+from importlib import import_module
+from inspect import isasyncgenfunction, iscoroutinefunction, isgeneratorfunction
+from json import dump
+import os
+from os import getpid
+from pickle import UnpicklingError, dumps as pickle_dumps, load as pickle_load
+from threading import Condition, RLock, Thread, get_ident, local
+from time import monotonic, perf_counter
+from typing import get_type_hints
+from warnings import warn
+from weakref import WeakSet, finalize
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec
+
+
+# Kinds of registered objects; _IMPORT is an import path not yet imported
+_TYPE, _FUNCTION, _COROUTINE, _INSTANCE, _IMPORT = range(5)
+
+# Kinds of dependency names, based on their suffix. In plans, arguments
+# without a suffix that are annotated with a class are _TYPED, with the
+# class in place of the base name.
+_PLAIN, _LIST, _ITER, _FACT, _LAZY, _OWNED, _INVALID, _TYPED = range(8)
+
+_parsed_names = {}
+_MISSING = object()
+_lazy_lock = RLock()
+_import_lock = RLock()
+
+# Containers with per-process registrations, which are reset after a fork
+_fork_containers = WeakSet()
+
+# Lifetimes of instances shared within a context
+_LIFETIMES = ("thread", "task")
+
+# The task that called resolve_async, inherited by the tasks it spawns
+_resolving_task = ContextVar("dipy_resolving_task", default=None)
+
+
+def _parse_name(name):
+    """ Split a dependency name into its suffix kind and base name. """
+    parsed = _parsed_names.get(name)
+    if parsed is None:
+        if name.endswith("_fact_list") or name.endswith("_fact_iter"):
+            parsed = (_INVALID, name)
+        elif name.endswith("_list"):
+            parsed = (_LIST, name[:-5])
+        elif name.endswith("_iter"):
+            parsed = (_ITER, name[:-5])
+        elif name.endswith("_fact"):
+            parsed = (_FACT, name[:-5])
+        elif name.endswith("_lazy"):
+            parsed = (_LAZY, name[:-5])
+        elif name.endswith("_owned"):
+            parsed = (_OWNED, name[:-6])
+        else:
+            parsed = (_PLAIN, name)
+        _parsed_names[name] = parsed
+    return parsed
+
+
+def _kind_of(obj):
+    if isinstance(obj, type):
+        return _TYPE
+    if type(obj) == type(lambda: 1):
+        return _COROUTINE if iscoroutinefunction(obj) else _FUNCTION
+    return _INSTANCE
+
+
+class _Registration(object):
+    """ A component registered against a container, along with its
+    resolution plan. The plan is computed on first use and lists the
+    (argument, kind, base name) of every constructor argument.
+    """
+
+    __slots__ = ('name', 'obj', 'kind', 'single_instance', 'locally_owned', 'lifetime', 'pool',
+                 'memoize', 'memoize_ttl', 'per_process', 'tags', 'shared', 'plan', 'recording')
+
+    def __init__(self, name, obj, single_instance, locally_owned, lifetime=None, pool=None,
+                 memoize=None, memoize_ttl=None, lazy_import=False, per_process=False, tags=None):
+        self.name = name
+        self.tags = tags
+        self.per_process = per_process
+        self.obj = obj
+        self.single_instance = single_instance
+        self.locally_owned = locally_owned
+        self.lifetime = lifetime
+        self.pool = pool
+        self.memoize = memoize
+        self.memoize_ttl = memoize_ttl
+        # Shared instances may be used by anything built after them
+        self.shared = single_instance or pool is not None
+        self.plan = None
+        self.recording = None
+        self.kind = _IMPORT if lazy_import else _kind_of(obj)
+
+    def load(self):
+        """ Import the object of an import path registration. """
+        if self.kind != _IMPORT:
+            return
+        with _import_lock:
+            if self.kind != _IMPORT:
+                return
+            path = self.obj
+            if ':' in path:
+                module_name, _, attributes = path.partition(':')
+            else:
+                module_name, _, attributes = path.rpartition('.')
+            try:
+                obj = import_module(module_name)
+                for attribute in attributes.split('.'):
+                    obj = getattr(obj, attribute)
+            except (ImportError, AttributeError, ValueError) as error:
+                raise DipyException(
+                    "Unable to import '%s' for '%s': %s" % (path, self.name, error)) from error
+            # Publish the kind last, as it is read without the lock
+            kind = _kind_of(obj)
+            self.obj = obj
+            if kind == _TYPE:
+                self.build_plan()
+            self.kind = kind
+
+    def build_plan(self):
+        init = self.obj.__init__
+        init_args = getargspec(init)[0]
+        hints = {}
+        if getattr(init, '__annotations__', None):
+            try:
+                hints = get_type_hints(init)
+            except Exception:
+                hints = init.__annotations__
+        plan = []
+        for arg in init_args[1:]:
+            kind, base = _parse_name(arg)
+            if kind == _PLAIN and isinstance(hints.get(arg), type):
+                kind, base = _TYPED, hints[arg]
+            plan.append((arg, kind, base))
+        self.plan = tuple(plan)
+        return self.plan
 
 
 class Container(object):
+
+    __slots__ = ('parent', 'registry', 'dispose_workers', 'dispose_timeout',
+                 '_autostub', '_instances', '_single_instances',
+                 '_generation', '_epoch', '_index', '_index_epoch', '_index_generation',
+                 '_compiled', '_scope_pool', '_singleton_locks', '_async_singletons',
+                 '_thread_local', '_context_finalizers', '_task_instances', '_memos',
+                 '_factories', '_listeners', '_by_type', '_types', '_tag_index',
+                 '__weakref__')
     
-    def __init__(self, parent=None, autostub=False):
+    def __init__(self, parent=None, autostub=False, dispose_workers=None, dispose_timeout=None,
+                 by_type=False):
         super(Container, self).__init__()
         self.parent = parent
         self.registry = {}
-        self._autostub = autostub
+        self.dispose_workers = dispose_workers
+        self.dispose_timeout = dispose_timeout
+        # Missing dependencies are stubbed by calling _autostub with their name
+        if autostub is True:
+            autostub = Stub
+        self._autostub = autostub or (parent._autostub if parent is not None else None)
         self._instances = []
         self._single_instances = {}
+        self._generation = 0
+        self._epoch = parent._epoch if parent is not None else [0]
+        self._index = {}
+        self._index_epoch = -1
+        self._index_generation = -1
+        self._compiled = {}
+        self._scope_pool = []
+        self._singleton_locks = {}
+        self._async_singletons = {}
+        self._thread_local = None
+        self._context_finalizers = []
+        self._task_instances = {}
+        self._memos = {}
+        self._factories = {}
+        # Listeners are shared by the whole heirarchy
+        self._listeners = parent._listeners if parent is not None else []
+        # Annotated constructor arguments are resolved by type, through the
+        # index of the first registration of each class and its bases
+        self._by_type = by_type or (parent is not None and parent._by_type)
+        self._types = {}
+        # For each name, the positions in its registry list of the
+        # registrations with each (tag, value)
+        self._tag_index = {}
     
-    def register(self, name, obj, single_instance=False, locally_owned=True):
+    def register(self, name, obj, single_instance=False, locally_owned=True, lifetime=None,
+                 pool_size=None, pool_reset=None, pool_timeout=None, memoize=None,
+                 memoize_ttl=None, lazy_import=False, record=None, replay=None,
+                 per_process=False, tags=None):
         """ Register the specified object with the given name.
 
         Keyword arguments:
         single_instace -- At most one instance is to be created (default False)
         locally_owned -- Instances are owned by the container on which they
         were resolved (default True)
+        lifetime -- "thread" or "task" to share one instance per thread or
+        per asyncio task, disposed of when the thread or task ends. Such
+        instances are always owned by this container. (default None)
+        pool_size -- Reuse instances from a pool of at most this many,
+        created on demand and disposed of with this container. Each resolve
+        checks an instance out until the resolving container exits.
+        (default None)
+        pool_reset -- Called with each instance as it returns to the pool
+        (default None)
+        pool_timeout -- Seconds to wait for an instance when the pool is
+        exhausted before raising a DipyException (default None, wait forever)
+        memoize -- Keep up to this many instances in an LRU cache on the
+        owning container, keyed by the arguments passed to the component's
+        factory. Evicted instances are disposed of. (default None)
+        memoize_ttl -- Seconds after which a memoized instance is evicted
+        (default None, never)
+        lazy_import -- 'obj' is an import path such as "package.module:Class",
+        only imported when the component is first resolved (default False)
+        record -- Record the method calls and return values of resolved
+        instances, saving them to this file when this container exits
+        (default None)
+        replay -- Instead of 'obj', register a Stub answering calls with the
+        return values recorded in this file (default None)
+        per_process -- The single instance is not shared with processes
+        forked from this one; each builds its own on first use. Such
+        instances are always owned by this container. Only this instance
+        is forgotten: a regular single instance built with it keeps the
+        parent's, so whatever depends on it must be per-process too, or be
+        built after the fork. (default False)
+        tags -- A dictionary of metadata, for selecting and ordering the
+        components of a name with resolve_list (default None)
         """
+        if replay is not None:
+            obj = Stub.from_recording(replay, name)
+            single_instance, lifetime, pool_size, memoize, lazy_import = False, None, None, None, False
+        if per_process:
+            if not single_instance:
+                raise DipyException("Only a single instance can be per-process")
+            locally_owned = False
+            _fork_containers.add(self)
+        if lifetime is not None:
+            if lifetime not in _LIFETIMES:
+                raise DipyException("Unknown lifetime '%s'" % (lifetime,))
+            if single_instance:
+                raise DipyException(
+                    "A single instance can't also have a '%s' lifetime" % lifetime)
+            locally_owned = False
+        pool = None
+        if pool_size is not None:
+            if single_instance or lifetime is not None:
+                raise DipyException("A pooled component can't also be shared")
+            pool = _InstancePool(name, self, pool_size, pool_reset, pool_timeout)
+        if memoize is not None and (single_instance or lifetime is not None or pool is not None):
+            raise DipyException("A memoized component can't also be shared")
+        if lazy_import and not isinstance(obj, str):
+            raise DipyException("A lazy import must be registered with an import path")
+        if tags:
+            tags = dict(tags)
+            try:
+                for item in tags.items():
+                    hash(item)
+            except TypeError:
+                raise DipyException("The tags of '%s' must have hashable values" % name)
+        registration = _Registration(name, obj, single_instance, locally_owned, lifetime, pool,
+                                     memoize, memoize_ttl, lazy_import, per_process, tags or None)
+        if record is not None:
+            # Instances are wrapped in a recorder as they are built
+            registration.recording = _Recording(record)
+            self._add_instance(registration.recording, shared=True)
         # If the object is not a type or function, add it to the instance list
-        if not isinstance(obj, type) and not type(obj) == type(lambda: 1):
-            self._add_instance(obj)
-        self.registry.setdefault(name, []).append((obj, single_instance, locally_owned))
+        if registration.kind == _INSTANCE:
+            self._add_instance(obj, shared=True)
+        if registration.kind == _TYPE or registration.kind == _INSTANCE:
+            # Builtins like str are left out, as they say nothing of the role
+            for cls in (obj if registration.kind == _TYPE else type(obj)).__mro__:
+                if cls.__module__ != 'builtins':
+                    self._types.setdefault(cls, registration)
+            if registration.kind == _INSTANCE and registration.recording is not None:
+                registration.obj = _record(obj, registration.recording)
+        registrations = self.registry.setdefault(name, [])
+        if tags:
+            index = self._tag_index.setdefault(name, {})
+            for item in tags.items():
+                index.setdefault(item, []).append(len(registrations))
+        registrations.append(registration)
+        self._generation += 1
+        self._epoch[0] += 1
     
     def resolve(self, type, *args):
         """ Resolve the component named 'type' from the container. """
         if not isinstance(type, str):
             raise DipyException("Resolve must be passed a string argument")
+        if not args and not self._listeners:
+            compiled = self._compiled_for(type)
+            if compiled is not None:
+                return compiled(self)
         return self._resolve_from_str(type, self, False, *args)
+
+    async def resolve_async(self, type, *args):
+        """ Resolve the component named 'type' from the container, awaiting
+        async factories and __aenter__ along the way. Independent
+        constructor arguments are resolved concurrently.
+        """
+        if not isinstance(type, str):
+            raise DipyException("Resolve must be passed a string argument")
+        token = _resolving_task.set(current_task())
+        try:
+            return await self._resolve_from_str_async(type, self, False, *args)
+        finally:
+            _resolving_task.reset(token)
+
+    def resolve_list(self, type, *args, where=None, order_by=None):
+        """ Resolve the components registered as 'type' on this container,
+        like a '_list' dependency, but only those whose tags include every
+        key and value of 'where'. Components are in the order they were
+        registered, or ordered by the value of their 'order_by' tag, with
+        those lacking it last. Only the selected components are built.
+        """
+        if not isinstance(type, str):
+            raise DipyException("Resolve must be passed a string argument")
+        registrations = self.registry.get(type)
+        if registrations is None:
+            raise DipyException(
+                "The requested dependency '%s_list' could not be located" % type)
+        if where:
+            # Intersect the positions of each tag, starting with the rarest
+            index = self._tag_index.get(type, {})
+            try:
+                items = sorted(where.items(), key=lambda item: len(index.get(item, ())))
+            except TypeError:
+                raise DipyException("Tags can only be matched against hashable values")
+            selected = set(index.get(items[0], ()))
+            for item in items[1:]:
+                if not selected:
+                    break
+                selected.intersection_update(index.get(item, ()))
+            registrations = [registrations[position] for position in sorted(selected)]
+        if order_by is not None:
+            registrations = sorted(registrations, key=lambda registration: (
+                not registration.tags or order_by not in registration.tags,
+                registration.tags and registration.tags.get(order_by)))
+        return [self._create_instance(type, registration, False, *args)
+                for registration in registrations]
+
+    def resolve_iter(self, type, *args):
+        """ Return an iterator over every component registered as 'type',
+        building each one only when it is pulled from the iterator.
+        """
+        if not isinstance(type, str):
+            raise DipyException("Resolve must be passed a string argument")
+        return self._resolve_from_str(type + "_iter", self, False, *args)
+
+    def request_scope(self):
+        """ Return a child container for the duration of a single request.
+        Scopes are pooled: once a scope's __exit__ has disposed of its
+        instances, it is reset and handed out again by a later call.
+        """
+        try:
+            return self._scope_pool.pop()
+        except IndexError:
+            return RequestScope(self)
+
+    def preload(self, background=False):
+        """ Import the object of every lazy import registered on this
+        container and its parents, caching their constructor signatures.
+
+        With background=True, the imports are made on a daemon thread,
+        which is returned; import errors are then left to be raised when
+        the component is resolved.
+        """
+        registrations = []
+        container = self
+        while container is not None:
+            registrations.extend(registration for registrations in container.registry.values()
+                                 for registration in registrations
+                                 if registration.kind == _IMPORT)
+            container = container.parent
+        if not background:
+            for registration in registrations:
+                registration.load()
+            return None
+
+        def load():
+            for registration in registrations:
+                try:
+                    registration.load()
+                except DipyException:
+                    pass
+
+        thread = Thread(target=load, name="dipy-preload", daemon=True)
+        thread.start()
+        return thread
+
+    def add_listener(self, listener):
+        """ Notify 'listener', a ResolutionListener, of resolutions,
+        instances and disposals in this container's whole heirarchy: the
+        root container, and every child container and request scope created
+        from it. While any listener is attached, compiled resolvers are not
+        used.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Stop notifying a listener added with add_listener. """
+        self._listeners.remove(listener)
+
+    def _notify(self, event, *args):
+        for listener in self._listeners:
+            getattr(listener, event)(self, *args)
+
+    def pool_stats(self, name):
+        """ Return statistics for the pool of the component 'name': its size,
+        how many instances were created and are idle, checkouts served from
+        the pool (hits) or by creating an instance (misses), the hit rate,
+        and how many checkouts waited and for how long in total.
+        """
+        target = self._find(name)
+        if target is None or target[1].pool is None:
+            raise DipyException("The component '%s' is not pooled" % name)
+        return target[1].pool.stats()
+
+    def memo_stats(self, name):
+        """ Return the hits, misses, evictions and size of the memoization
+        cache of the component 'name' on this container, summed over its
+        registrations when it has several.
+        """
+        stats = None
+        for registration, memo in list(self._memos.items()):
+            if registration.name == name:
+                if stats is None:
+                    stats = memo.stats()
+                else:
+                    for key, value in memo.stats().items():
+                        stats[key] += value
+        if stats is None:
+            raise DipyException("No instances of '%s' are memoized by this container" % name)
+        return stats
+
+    def warm_up(self, max_workers=None):
+        """ Eagerly build every single instance registered on this container.
+
+        Single instances that don't depend on each other are built in
+        parallel on a pool of max_workers threads; each is only started once
+        the single instances its constructor depends on have been built.
+        Returns a dictionary mapping each name to its build time in seconds.
+        If any constructor raises, no further components are started and a
+        DipyException naming the failed component is raised.
+        """
+        names = [name for name, registrations in self.registry.items()
+                 if registrations[0].single_instance]
+        dependencies = dict((name, self._single_instance_dependencies(name, set(names)))
+                            for name in names)
+        dependents = dict((name, []) for name in names)
+        for name in names:
+            for dependency in dependencies[name]:
+                dependents[dependency].append(name)
+        waiting = dict((name, len(dependencies[name])) for name in names)
+
+        def build(name):
+            start = perf_counter()
+            self.resolve(name)
+            return perf_counter() - start
+
+        report = {}
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            running = dict((executor.submit(build, name), name)
+                           for name in names if not waiting[name])
+            while running:
+                done, pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        raise DipyException(
+                            "Failed to warm up single instance '%s': %s" % (name, error)) from error
+                    report[name] = future.result()
+                    for dependent in dependents[name]:
+                        waiting[dependent] -= 1
+                        if not waiting[dependent]:
+                            running[executor.submit(build, dependent)] = dependent
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if len(report) < len(names):
+            raise DipyException("Single instances have cyclic dependencies: %s" %
+                                ", ".join(sorted(set(names) - set(report))))
+        return report
+
+    def _single_instance_dependencies(self, name, single_instances):
+        # Find the single instances that building 'name' would resolve,
+        # looking through transient components but not through factories
+        found, seen = set(), set()
+        pending = [registration for registration in self.registry[name][:1]]
+        while pending:
+            registration = pending.pop()
+            registration.load()
+            if id(registration) in seen or registration.kind != _TYPE:
+                continue
+            seen.add(id(registration))
+            plan = registration.plan
+            if plan is None:
+                plan = registration.build_plan()
+            for arg, kind, base in plan:
+                target = None
+                if kind == _TYPED:
+                    kind = _PLAIN
+                    base, target = self._find_typed(arg, base)
+                if kind == _OWNED:
+                    kind = _PLAIN
+                if kind == _PLAIN:
+                    if target is None:
+                        target = self._find(base)
+                    if target is None:
+                        continue
+                    if base in single_instances and target[0] is self:
+                        found.add(base)
+                    else:
+                        pending.append(target[1])
+                elif kind == _LIST or kind == _ITER:
+                    if base in single_instances:
+                        found.add(base)
+                    pending.extend(registration for registration in self.registry.get(base, ())
+                                   if not registration.single_instance)
+        return found
+
+    def verify(self, ignore=()):
+        """ Check, without building anything, that every component visible
+        from this container can be resolved from it.
+
+        Returns a dictionary with the 'missing' dependencies, as (component,
+        argument) pairs, and the constructor 'cycles', each listed as the
+        names along the cycle, ending with the name it started from. Only
+        dependencies that are built along with a component form cycles;
+        factories, lazy proxies and iterators break them.
+
+        Arguments that are always passed explicitly to a component, rather
+        than resolved, should be named in 'ignore'.
+        """
+        nodes, edges, missing = self._dependency_graph(ignore)
+        cycles = [[nodes[key][0] for key in cycle] for cycle in _find_cycles(edges)]
+        return {'missing': sorted(set(missing)), 'cycles': sorted(cycles)}
+
+    def to_dot(self, ignore=()):
+        """ Return the dependency graph of the components visible from this
+        container in the Graphviz DOT language. Single instances are drawn
+        as boxes, dependencies that aren't built along with their component
+        as dashed edges, and missing dependencies in red.
+        """
+        nodes, edges, missing = self._dependency_graph(ignore)
+        ids = dict((key, 'n%d' % number) for number, key in enumerate(nodes))
+        lines = ['digraph dependencies {']
+        for key, (name, registration, owner) in nodes.items():
+            shape = 'box' if registration.single_instance else 'ellipse'
+            lines.append('    %s [label="%s", shape=%s];' % (ids[key], name, shape))
+        for key, dependencies in edges.items():
+            for dependency, arg, eager in dependencies:
+                style = '' if eager else ', style=dashed'
+                lines.append('    %s -> %s [label="%s"%s];' % (ids[key], ids[dependency], arg, style))
+        for number, (name, arg) in enumerate(sorted(set(missing))):
+            lines.append('    m%d [label="%s", color=red, fontcolor=red];' % (number, arg))
+            for key, (node_name, registration, owner) in nodes.items():
+                if node_name == name:
+                    lines.append('    %s -> m%d [color=red];' % (ids[key], number))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def _dependency_graph(self, ignore):
+        """ Return the components visible from this container as nodes,
+        keyed by (owning container, registration) as each would be built
+        when resolved from this container, the (node, argument, eager)
+        edges from each node to its dependencies, and the (component,
+        argument) pairs that can't be resolved.
+        """
+        nodes, edges, missing, pending = {}, {}, [], []
+
+        def node(name, registration, owner):
+            key = (id(owner), id(registration))
+            if key not in nodes:
+                nodes[key] = (name, registration, owner)
+                pending.append(key)
+            return key
+
+        container = self
+        while container is not None:
+            for name, registrations in container.registry.items():
+                for registration in registrations:
+                    node(name, registration, self if registration.locally_owned else container)
+            container = container.parent
+
+        while pending:
+            key = pending.pop()
+            name, registration, owner = nodes[key]
+            dependencies = edges[key] = []
+            registration.load()
+            if registration.kind != _TYPE:
+                continue
+            plan = registration.plan
+            if plan is None:
+                plan = registration.build_plan()
+            # Instances are built by their owner, which resolves their
+            # dependencies in turn
+            for arg, kind, base in plan:
+                if arg in ignore:
+                    continue
+                target = None
+                if kind == _TYPED:
+                    kind = _PLAIN
+                    base, target = owner._find_typed(arg, base)
+                eager = kind == _PLAIN or kind == _LIST or kind == _OWNED
+                if kind == _LIST or kind == _ITER:
+                    if base not in owner.registry:
+                        missing.append((name, arg))
+                    for dependency in owner.registry.get(base, ()):
+                        dependencies.append((node(base, dependency, owner), arg, eager))
+                elif kind == _INVALID:
+                    missing.append((name, arg))
+                else:
+                    if target is None:
+                        target = owner._find(base)
+                    if target is None:
+                        if not owner._autostub:
+                            missing.append((name, arg))
+                        continue
+                    container, dependency = target
+                    dependency_owner = owner if dependency.locally_owned else container
+                    dependencies.append((node(base, dependency, dependency_owner), arg, eager))
+        return nodes, edges, missing
+
+    def compile(self, *names):
+        """ Generate specialized resolver functions for the named components
+        (default: every component registered on this container). A compiled
+        component is built by a single call that directly instantiates its
+        whole dependency tree. Components that cannot be compiled, such as
+        those with missing dependencies or cycles, keep using the regular
+        resolver, as do all components once the registry changes.
+
+        Returns the list of names that were compiled.
+        """
+        index = self._current_index()
+        compiled = []
+        for name in names or list(self.registry):
+            compiler = _Compiler(self)
+            try:
+                source, function = compiler.compile(name)
+            except _CompileError:
+                continue
+            self._compiled[name] = (index, function, source, compiler.scoped)
+            compiled.append(name)
+        return compiled
+
+    def compiled_source(self, name):
+        """ Return the generated source of a compiled component, or None. """
+        compiled = self._compiled.get(name)
+        return compiled[2] if compiled is not None else None
+
+    def _compiled_for(self, name):
+        # Containers without registrations of their own resolve exactly as
+        # their parent does, so they can use the parent's compiled functions,
+        # except where those list the request scope's own registrations
+        container = self
+        while True:
+            compiled = container._compiled.get(name)
+            if compiled is not None:
+                if compiled[0] is container._current_index() and (
+                        container is self or not compiled[3]):
+                    return compiled[1]
+                return None
+            if container.registry or container.parent is None:
+                return None
+            container = container.parent
     
     def _resolve_from_str(self, name, request_scope, comp_owned, *args):
-        # Validate the requested name
-        if name.endswith("_fact_list"):
+        kind, base = _parse_name(name)
+        return self._resolve_parsed(name, kind, base, request_scope, comp_owned, *args)
+
+    def _resolve_parsed(self, name, kind, base, request_scope, comp_owned, *args):
+        # If the dependency is registered in the container heirarchy, create
+        # the instance. Arguments annotated with a class are resolved by type
+        # when enabled.
+        if kind == _PLAIN or kind == _TYPED:
+            if kind == _PLAIN:
+                target = self._find(name)
+            else:
+                name, target = self._find_typed(name, base)
+            if target is not None:
+                container, registration = target
+                owner = request_scope if registration.locally_owned else container
+                if self._listeners:
+                    return owner._observe(name, owner._create_instance, name, registration,
+                                          comp_owned, *args)
+                return owner._create_instance(name, registration, comp_owned, *args)
+
+            # If stubbing is enabled, create a new stub
+            if self._autostub:
+                return self._autostub(name)
+
+            # If no matching registration is found, raise an exception
             raise DipyException(
-                "The requested dependency name '%s' is not valid." % name)
-                        
+                "The requested dependency '%s' could not be located" % name)
+
         # See if a list of dependencies is requested
-        if name.endswith('_list'):
-            if name[:-5] not in self.registry:
+        if kind == _LIST:
+            if base not in self.registry:
                 raise DipyException(
                     "The requested dependency '%s' could not be located" % name)
-            return [(request_scope if locally_owned else self)._create_instance(
-                        name[:-5], obj, single_instance, comp_owned, *args)
-                    for obj, single_instance, locally_owned in self.registry[name[:-5]]]
+            if self._listeners:
+                return self._observe(name, self._list_instances, base, request_scope,
+                                     comp_owned, args)
+            return self._list_instances(base, request_scope, comp_owned, args)
+
+        # See if an iterator over the dependencies is requested
+        if kind == _ITER:
+            if base not in self.registry:
+                raise DipyException(
+                    "The requested dependency '%s' could not be located" % name)
+            return self._iter_instances(base, tuple(self.registry[base]), request_scope,
+                                        comp_owned, args, name if self._listeners else None)
         
         # See if a factory is requested
-        if name.endswith('_fact'):
-            return lambda *args: self._resolve_from_str(name[:-5], request_scope, comp_owned, *args)
+        if kind == _FACT:
+            if self._listeners:
+                return lambda *args: self._observe(name, self._resolve_from_str, base,
+                                                   request_scope, comp_owned, *args)
+            if request_scope is self:
+                return self._factory(base, comp_owned)
+            return lambda *args: self._resolve_from_str(base, request_scope, comp_owned, *args)
+
+        # See if a lazily resolved instance is requested
+        if kind == _LAZY:
+            if self._listeners:
+                return LazyProxy(lambda: self._observe(name, self._resolve_from_str, base,
+                                                       request_scope, comp_owned))
+            return LazyProxy(lambda: self._resolve_from_str(base, request_scope, comp_owned))
 
         # See if an owned instance is requested
-        if name.endswith('_owned'):
-            return self._resolve_from_str(name[:-6], request_scope, True, *args)
-        
-        # If the dependency is registered in the current container, create the instance
-        if name in self.registry:
-            obj, single_instance, locally_owned= self.registry[name][0]
-            owner = request_scope if locally_owned else self
-            return owner._create_instance(name, obj, single_instance, comp_owned, *args)
-
-        # Search through the container heirarchy looking for the dependency
-        if self.parent:
-            try:
-                return self.parent._resolve_from_str(name, request_scope, comp_owned, *args)
-            except DipyException:
-                pass
-        
-        # If stubbing is enabled, create a new stub
-        if self._autostub:
-            return Stub(name)
-        
-        # If no matching registration is found, raise an exception
+        if kind == _OWNED:
+            if self._listeners:
+                return self._observe(name, self._resolve_from_str, base, request_scope, True,
+                                     *args)
+            return self._resolve_from_str(base, request_scope, True, *args)
+
         raise DipyException(
-            "The requested dependency '%s' could not be located" % name)    
+            "The requested dependency name '%s' is not valid." % name)
+
+    def _find_typed(self, arg, cls):
+        """ Return the name and (container, registration) to build for the
+        argument 'arg' annotated with 'cls': the first registration of that
+        class, or one of its subclasses, nearest this container, falling
+        back to whatever 'arg' itself resolves to.
+        """
+        if self._by_type:
+            container = self
+            while container is not None:
+                registration = container._types.get(cls)
+                if registration is not None:
+                    return registration.name, (container, registration)
+                container = container.parent
+        return arg, self._find(arg)
+
+    def _factory(self, name, comp_owned, is_async=False):
+        # Factories resolving in this container are created once per name
+        key = (name, comp_owned, is_async)
+        factory = self._factories.get(key)
+        if factory is None:
+            if is_async:
+                factory = lambda *args: self._resolve_from_str_async(name, self, comp_owned, *args)
+            else:
+                factory = lambda *args: self._resolve_from_str(name, self, comp_owned, *args)
+            factory = self._factories.setdefault(key, factory)
+        return factory
 
-    def _create_instance(self, name, obj, single_instance, comp_owned, *args):
+    def _list_instances(self, name, request_scope, comp_owned, args):
+        return [(request_scope if registration.locally_owned else self)._create_instance(
+                    name, registration, comp_owned, *args)
+                for registration in self.registry[name]]
+
+    def _iter_instances(self, name, registrations, request_scope, comp_owned, args,
+                        observed=None):
+        # Yield without keeping a reference, so instances the consumer has
+        # dropped can be collected. While listeners are attached, each
+        # instance is observed under the requested name in 'observed'.
+        for registration in registrations:
+            owner = request_scope if registration.locally_owned else self
+            if observed is None:
+                yield owner._create_instance(name, registration, comp_owned, *args)
+            else:
+                yield owner._observe(observed, owner._create_instance, name, registration,
+                                     comp_owned, *args)
+
+    async def _resolve_from_str_async(self, name, request_scope, comp_owned, *args):
+        kind, base = _parse_name(name)
+        return await self._resolve_parsed_async(
+            name, kind, base, request_scope, comp_owned, *args)
+
+    async def _resolve_parsed_async(self, name, kind, base, request_scope, comp_owned, *args):
+        # Mirrors _resolve_parsed, building instances with _create_instance_async
+        if kind == _PLAIN or kind == _TYPED:
+            if kind == _PLAIN:
+                target = self._find(name)
+            else:
+                name, target = self._find_typed(name, base)
+            if target is not None:
+                container, registration = target
+                owner = request_scope if registration.locally_owned else container
+                if self._listeners:
+                    return await owner._observe_async(
+                        name, owner._create_instance_async(name, registration, comp_owned, *args))
+                return await owner._create_instance_async(name, registration, comp_owned, *args)
+            if self._autostub:
+                return self._autostub(name)
+            raise DipyException(
+                "The requested dependency '%s' could not be located" % name)
+
+        if kind == _LIST or kind == _ITER:
+            if base not in self.registry:
+                raise DipyException(
+                    "The requested dependency '%s' could not be located" % name)
+            registrations = tuple(self.registry[base])
+            if kind == _ITER:
+                return self._iter_instances_async(base, registrations, request_scope,
+                                                  comp_owned, args,
+                                                  name if self._listeners else None)
+            return list(await gather(*[
+                (request_scope if registration.locally_owned else self)._create_instance_async(
+                    base, registration, comp_owned, *args)
+                for registration in registrations]))
+
+        # Factories return a coroutine to be awaited
+        if kind == _FACT:
+            if self._listeners:
+                return lambda *args: self._observe_async(name, self._resolve_from_str_async(
+                    base, request_scope, comp_owned, *args))
+            if request_scope is self:
+                return self._factory(base, comp_owned, True)
+            return lambda *args: self._resolve_from_str_async(
+                base, request_scope, comp_owned, *args)
+
+        # Proxies can't await, so lazy dependencies are resolved synchronously
+        if kind == _LAZY:
+            return self._resolve_parsed(name, kind, base, request_scope, comp_owned)
+
+        if kind == _OWNED:
+            if self._listeners:
+                return await self._observe_async(name, self._resolve_from_str_async(
+                    base, request_scope, True, *args))
+            return await self._resolve_from_str_async(base, request_scope, True, *args)
+
+        raise DipyException(
+            "The requested dependency name '%s' is not valid." % name)
+
+    async def _iter_instances_async(self, name, registrations, request_scope, comp_owned, args,
+                                    observed=None):
+        for registration in registrations:
+            owner = request_scope if registration.locally_owned else self
+            if observed is None:
+                yield await owner._create_instance_async(name, registration, comp_owned, *args)
+            else:
+                yield await owner._observe_async(
+                    observed, owner._create_instance_async(name, registration, comp_owned, *args))
+
+    def _find(self, name):
+        """ Locate the container and registration that 'name' resolves to,
+        or None if it is not registered anywhere in the heirarchy.
+        """
+        # Containers without registrations of their own resolve exactly as
+        # their parent does, so they don't need an index
+        container = self
+        while not container.registry and container.parent is not None:
+            container = container.parent
+        index = container._current_index()
+        target = index.get(name)
+        if target is None and container.parent is not None:
+            # Names registered further up are looked up once, then cached
+            target = container.parent._find(name)
+            if target is not None:
+                index[name] = target
+        return target
+
+    def _current_index(self):
+        """ Return the index mapping names visible from this container to
+        their (container, registration). It starts out with this container's
+        own registrations, and _find adds the names of its parents as they
+        are used, so short-lived containers don't copy their parents' index.
+
+        Any register in the heirarchy bumps the shared epoch; the index is
+        only rebuilt when this container or one of its parents has actually
+        gained a registration since it was built.
+        """
+        epoch = self._epoch[0]
+        if self._index_epoch != epoch:
+            generation = self._chain_generation()
+            if generation != self._index_generation:
+                self._index = dict((name, (self, registrations[0]))
+                                   for name, registrations in self.registry.items())
+                self._index_generation = generation
+            self._index_epoch = epoch
+        return self._index
+
+    def _chain_generation(self):
+        # Generations only ever increase, so their sum changes whenever any
+        # container in the heirarchy gains a registration
+        generation, container = 0, self
+        while container is not None:
+            generation += container._generation
+            container = container.parent
+        return generation
+
+    def _create_instance(self, name, registration, comp_owned, *args):
+        # If the component is memoized, look it up by its arguments
+        if registration.memoize is not None and _hashable(args):
+            memo = self._memo(registration)
+            instance = memo.get(args)
+            if instance is _MISSING:
+                instance = memo.put(args, self._build_instance(registration, True, *args))
+            return instance
+        # If the component is pooled, lease an instance to this container
+        if registration.pool is not None:
+            instance = registration.pool.checkout(registration, *args)
+            self._add_instance(_PoolLease(registration.pool, instance))
+            return instance
         # If a single instance is required, create and store it
-        if single_instance:
-            if name not in self._single_instances: 
-                self._single_instances[name] = self._create_instance(name, obj, False, comp_owned, *args)
-            return self._single_instances[name]
+        if registration.single_instance:
+            instance = self._single_instances.get(name, _MISSING)
+            if instance is _MISSING:
+                with self._singleton_lock(name):
+                    instance = self._single_instances.get(name, _MISSING)
+                    if instance is _MISSING:
+                        instance = self._single_instances[name] = self._build_instance(
+                            registration, comp_owned, *args)
+            elif self._listeners:
+                self._notify('singleton_hit', name, instance)
+            return instance
+        # If an instance per thread or task is required, create and store it
+        if registration.lifetime is not None:
+            context = self._context_instances(registration.lifetime)
+            instance = context.instances.get(name, _MISSING)
+            if instance is _MISSING:
+                # The instance is shared, so it is owned by the context even
+                # when resolved as '_owned'
+                instance = self._build_instance(registration, True, *args)
+                context.instances[name] = instance = context.add(instance)
+            return instance
+        return self._build_instance(registration, comp_owned, *args)
+
+    def _observe(self, name, resolve, *args):
+        # Only used while listeners are attached, which keeps their checks
+        # off the path of unobserved resolves
+        self._notify('resolve_started', name)
+        start = perf_counter()
+        try:
+            instance = resolve(*args)
+        except Exception as error:
+            self._notify('resolve_finished', name, perf_counter() - start, error)
+            raise
+        self._notify('resolve_finished', name, perf_counter() - start, None)
+        return instance
+
+    async def _observe_async(self, name, resolving):
+        self._notify('resolve_started', name)
+        start = perf_counter()
+        try:
+            instance = await resolving
+        except Exception as error:
+            self._notify('resolve_finished', name, perf_counter() - start, error)
+            raise
+        self._notify('resolve_finished', name, perf_counter() - start, None)
+        return instance
+
+    def _memo(self, registration):
+        # Each registration has a cache of its own, even when several share
+        # a name
+        memo = self._memos.get(registration)
+        if memo is None:
+            memo = self._memos.setdefault(
+                registration, _MemoCache(registration.memoize, registration.memoize_ttl))
+        return memo
+
+    def _context_instances(self, lifetime):
+        """ Return the _ContextInstances of the current thread or task. """
+        if lifetime == "thread":
+            if self._thread_local is None:
+                with _lazy_lock:
+                    if self._thread_local is None:
+                        self._thread_local = local()
+            context = getattr(self._thread_local, 'context', None)
+            if context is None:
+                # The thread's locals are released when it ends, which
+                # triggers the finalizer
+                context = self._thread_local.context = _ContextInstances()
+                self._context_finalizers = [f for f in self._context_finalizers if f.alive]
+                self._context_finalizers.append(
+                    finalize(context, _dispose_context_instances, context.instances, context.entries))
+            return context
+
+        task = _resolving_task.get()
+        if task is None:
+            try:
+                task = current_task()
+            except RuntimeError:
+                task = None
+            if task is None:
+                raise DipyException("A 'task' lifetime requires a running asyncio task")
+        context = self._task_instances.get(task)
+        if context is None:
+            context = self._task_instances[task] = _ContextInstances()
+            task.add_done_callback(self._task_done)
+        return context
+
+    def _task_done(self, task):
+        context = self._task_instances.pop(task, None)
+        if context is not None:
+            _dispose_context_instances(context.instances, context.entries)
+
+    async def _create_instance_async(self, name, registration, comp_owned, *args):
+        if registration.memoize is not None and _hashable(args):
+            memo = self._memo(registration)
+            instance = memo.get(args)
+            if instance is _MISSING:
+                instance = await self._build_instance_async(registration, True, *args)
+                instance = memo.put(args, instance)
+            return instance
+        if registration.pool is not None:
+            instance = await registration.pool.checkout_async(registration, *args)
+            self._add_instance(_PoolLease(registration.pool, instance))
+            return instance
+        if registration.lifetime is not None:
+            context = self._context_instances(registration.lifetime)
+            instance = context.instances.get(name, _MISSING)
+            if instance is _MISSING:
+                instance = await self._build_instance_async(registration, True, *args)
+                context.instances[name] = instance = context.add(instance)
+            return instance
+        if registration.single_instance:
+            instance = self._single_instances.get(name, _MISSING)
+            if instance is _MISSING:
+                # Concurrent resolves of the same single instance all wait
+                # on the first one's build
+                building = self._async_singletons.get(name)
+                if building is None:
+                    building = ensure_future(self._build_single_instance_async(
+                        name, registration, comp_owned, *args))
+                    self._async_singletons[name] = building
+                    building.add_done_callback(
+                        lambda task: self._async_singletons.pop(name, None))
+                instance = await shield(building)
+            elif self._listeners:
+                self._notify('singleton_hit', name, instance)
+            return instance
+        return await self._build_instance_async(registration, comp_owned, *args)
+
+    async def _build_single_instance_async(self, name, registration, comp_owned, *args):
+        instance = await self._build_instance_async(registration, comp_owned, *args)
+        return self._single_instances.setdefault(name, instance)
+
+    def _singleton_lock(self, name):
+        # Each name gets its own lock, so unrelated single instances can be
+        # built concurrently. setdefault is atomic, so only one lock wins.
+        lock = self._singleton_locks.get(name)
+        if lock is None:
+            lock = self._singleton_locks.setdefault(name, RLock())
+        return lock
+
+    def _build_instance(self, registration, comp_owned, *args):
+        # Read the kind before the object, as load() publishes the kind last
+        obj_kind = registration.kind
+        obj = registration.obj
+        # Anything tracked while this instance is being built is one of its
+        # dependencies
+        start = len(self._instances)
         # If the object is a type, resolve that type
-        elif isinstance(obj, type):
+        if obj_kind == _TYPE:
             # Create instance based on the named arguments for the constructor
-            init = obj.__init__
-            init_args, ignore_1, ignore_2, ignore_4 = getargspec(init)
+            plan = registration.plan
+            if plan is None:
+                plan = registration.build_plan()
+            if args:
+                plan = plan[len(args):]
             resolved_args = {}
-            for arg in list(init_args)[(1 + len(args)):]:
-                resolved_args[arg] = self._resolve_from_str(arg, self, False)
+            for arg, kind, base in plan:
+                resolved_args[arg] = self._resolve_parsed(arg, kind, base, self, False)
             instance = obj(*args, **resolved_args)
-            return instance if comp_owned else self._add_instance(instance)
         # If the object is a function, call it with the container
-        elif type(obj) == type(lambda: 1):
+        elif obj_kind == _FUNCTION:
             instance = obj(self)
-            return instance if comp_owned else self._add_instance(instance)
+        elif obj_kind == _COROUTINE:
+            raise DipyException(
+                "The async factory %r must be resolved with resolve_async" % (obj,))
+        # Import the object on first use
+        elif obj_kind == _IMPORT:
+            registration.load()
+            return self._build_instance(registration, comp_owned, *args)
         # Otherwise, just return the registered instance
-        return obj
+        else:
+            return obj
+        if registration.recording is not None:
+            instance = _record(instance, registration.recording)
+        if self._listeners:
+            self._notify('instance_created', registration.name, instance)
+        return instance if comp_owned else self._add_instance(
+            instance, start, registration.shared)
 
-    def _add_instance(self, obj):
+    async def _build_instance_async(self, registration, comp_owned, *args):
+        # Read the kind before the object, as load() publishes the kind last
+        obj_kind = registration.kind
+        obj = registration.obj
+        start = len(self._instances)
+        if obj_kind == _TYPE:
+            plan = registration.plan
+            if plan is None:
+                plan = registration.build_plan()
+            if args:
+                plan = plan[len(args):]
+            if len(plan) == 1:
+                arg, kind, base = plan[0]
+                resolved_args = {arg: await self._resolve_parsed_async(arg, kind, base, self, False)}
+            else:
+                # Build independent constructor arguments concurrently
+                values = await gather(*[self._resolve_parsed_async(arg, kind, base, self, False)
+                                        for arg, kind, base in plan])
+                resolved_args = dict(zip([arg for arg, kind, base in plan], values))
+            instance = obj(*args, **resolved_args)
+        elif obj_kind == _FUNCTION:
+            instance = obj(self)
+        elif obj_kind == _COROUTINE:
+            instance = await obj(self)
+        elif obj_kind == _IMPORT:
+            registration.load()
+            return await self._build_instance_async(registration, comp_owned, *args)
+        else:
+            return obj
+        if registration.recording is not None:
+            instance = _record(instance, registration.recording)
+        if self._listeners:
+            self._notify('instance_created', registration.name, instance)
+        return instance if comp_owned else await self._add_instance_async(
+            instance, start, registration.shared)
+
+    def _add_instance(self, obj, start=None, shared=False):
         if hasattr(obj, '__enter__'):
             obj = obj.__enter__()
-        self._instances.append(obj)
+        # Only instances that need disposing are tracked; everything else
+        # is left to the garbage collector. Along with each instance, keep
+        # the number of instances tracked when it began to be built, and
+        # whether it may be shared by instances built later.
+        if hasattr(obj, '__exit__'):
+            if start is None:
+                start = len(self._instances)
+            self._instances.append((obj, start, shared, False))
+        return obj
+
+    async def _add_instance_async(self, obj, start=None, shared=False):
+        # Instances entered with __aenter__ are flagged, as only
+        # dispose_async can call their __aexit__
+        if hasattr(obj, '__aenter__'):
+            obj = await obj.__aenter__()
+            entered_async = True
+        else:
+            if hasattr(obj, '__enter__'):
+                obj = obj.__enter__()
+            entered_async = False
+        if hasattr(obj, '__aexit__' if entered_async else '__exit__'):
+            if start is None:
+                start = len(self._instances)
+            self._instances.append((obj, start, shared, entered_async))
         return obj
     
     def __enter__(self):
         return self
     
     def __exit__(self, type, value, traceback):
-        for instance in self._instances:
-            if hasattr(instance, '__exit__'):
-                instance.__exit__(type, value, traceback)
+        self.dispose(type, value, traceback,
+                     max_workers=self.dispose_workers, timeout=self.dispose_timeout)
+
+    def dispose(self, type=None, value=None, traceback=None, max_workers=None, timeout=None):
+        """ Call __exit__ on every instance owned by the container, disposing
+        of each instance before the instances it depends on.
+
+        Keyword arguments:
+        max_workers -- Dispose of independent instances in parallel on a
+        pool of this many threads (default None, dispose sequentially)
+        timeout -- Seconds to wait for each instance's __exit__; requires
+        the thread pool, which is then used even without max_workers
+        (default None)
+
+        Every instance is disposed even if some fail; the failures are then
+        raised together as a DisposalError.
+        """
+        entries, self._instances = self._instances, []
+        errors = self._dispose_contexts()
+        exit_instance = self._exit_observed if self._listeners else _exit_instance
+        if max_workers is None and timeout is None:
+            for entry in reversed(entries):
+                try:
+                    exit_instance(entry, type, value, traceback)
+                except Exception as error:
+                    errors.append((entry[0], error))
+        else:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            try:
+                for wave in _disposal_waves(entries):
+                    futures = [(entry[0], executor.submit(
+                                   exit_instance, entry, type, value, traceback))
+                               for entry in wave]
+                    for instance, future in futures:
+                        try:
+                            future.result(timeout=timeout)
+                        except FutureTimeoutError:
+                            errors.append((instance, DipyException(
+                                "Timed out disposing of %r" % (instance,))))
+                        except Exception as error:
+                            errors.append((instance, error))
+            finally:
+                # Don't hold up teardown waiting on instances that timed out
+                executor.shutdown(wait=False)
+        if errors:
+            raise DisposalError(errors)
+
+    def _exit_observed(self, entry, type, value, traceback):
+        start = perf_counter()
+        try:
+            _exit_instance(entry, type, value, traceback)
+        except Exception as error:
+            self._notify('instance_disposed', entry[0], perf_counter() - start, error)
+            raise
+        self._notify('instance_disposed', entry[0], perf_counter() - start, None)
+
+    async def _exit_observed_async(self, entry, type, value, traceback, timeout):
+        start = perf_counter()
+        try:
+            await _exit_instance_async(entry, type, value, traceback, timeout)
+        except Exception as error:
+            self._notify('instance_disposed', entry[0], perf_counter() - start, error)
+            raise
+        self._notify('instance_disposed', entry[0], perf_counter() - start, None)
+
+    def _after_fork(self):
+        """ Forget the per-process single instances inherited from the
+        parent process, without disposing of them, as they still belong to
+        the parent. Nothing else is modified, so that memory shared with
+        the parent stays shared.
+        """
+        # The locks may have been held by threads that didn't survive the fork
+        self._singleton_locks = {}
+        self._async_singletons = {}
+        forgotten = set()
+        for name, registrations in self.registry.items():
+            if registrations[0].per_process:
+                instance = self._single_instances.pop(name, _MISSING)
+                if instance is not _MISSING:
+                    forgotten.add(id(instance))
+        # Keep the positions of the remaining instances, which the disposal
+        # order depends on
+        if forgotten:
+            self._instances = [(_forgotten, entry[1], entry[2], False) if id(entry[0]) in forgotten
+                               else entry
+                               for entry in self._instances]
+
+    def _dispose_contexts(self):
+        # Dispose of the memoized instances, and the thread and task
+        # instances that are still alive
+        errors = []
+        finalizers, self._context_finalizers = self._context_finalizers, []
+        contexts, self._task_instances = self._task_instances, {}
+        memos, self._memos = self._memos, {}
+        for dispose in ([memo.clear for memo in memos.values()] + finalizers +
+                        [context.dispose for context in contexts.values()]):
+            try:
+                dispose()
+            except DisposalError as error:
+                errors.extend(error.errors)
+        return errors
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.dispose_async(type, value, traceback, timeout=self.dispose_timeout)
+
+    async def dispose_async(self, type=None, value=None, traceback=None, timeout=None):
+        """ Dispose of every instance owned by the container, awaiting
+        __aexit__ where instances were entered with __aenter__. Independent
+        instances are disposed of concurrently, dependents first, and
+        failures are raised together as a DisposalError.
+        """
+        entries, self._instances = self._instances, []
+        errors = self._dispose_contexts()
+        exit_instance = self._exit_observed_async if self._listeners else _exit_instance_async
+        for wave in _disposal_waves(entries):
+            results = await gather(*[exit_instance(entry, type, value, traceback, timeout)
+                                     for entry in wave], return_exceptions=True)
+            for entry, result in zip(wave, results):
+                if isinstance(result, AsyncTimeoutError):
+                    result = DipyException("Timed out disposing of %r" % (entry[0],))
+                if isinstance(result, Exception):
+                    errors.append((entry[0], result))
+        if errors:
+            raise DisposalError(errors)
+
+
+class _Forgotten(object):
+    """ Stands in for an instance that a forked process must not dispose of. """
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    async def __aexit__(self, type, value, traceback):
+        pass
+
+
+_forgotten = _Forgotten()
+
+
+def _after_fork_in_child():
+    global _lazy_lock, _import_lock
+    _lazy_lock = RLock()
+    _import_lock = RLock()
+    for container in list(_fork_containers):
+        container._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class _InstancePool(object):
+    """ A bounded pool of instances of a component. Instances are built by,
+    and disposed of with, the container the component is registered on.
+    """
+
+    def __init__(self, name, container, size, reset, timeout):
+        self.name = name
+        self.container = container
+        self.size = size
+        self.reset = reset
+        self.timeout = timeout
+        self._idle = []
+        self._created = 0
+        self._condition = Condition()
+        # The (event loop, future) of every task waiting for an instance
+        self._waiters = []
+        self.hits = self.misses = self.waits = 0
+        self.wait_time = 0.0
+
+    def checkout(self, registration, *args):
+        with self._condition:
+            if not self._idle and self._created >= self.size:
+                start = perf_counter()
+                self.waits += 1
+                available = self._condition.wait_for(
+                    lambda: self._idle or self._created < self.size, self.timeout)
+                self.wait_time += perf_counter() - start
+                if not available:
+                    raise DipyException(
+                        "Timed out waiting for a pooled instance of '%s'" % self.name)
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self._created += 1
+            self.misses += 1
+        return self._create(registration, *args)
+
+    async def checkout_async(self, registration, *args):
+        # Waiting on the condition would block the event loop, so wait for a
+        # future that is resolved when an instance is returned instead
+        start = None
+        while True:
+            with self._condition:
+                if self._idle:
+                    self.hits += 1
+                    instance = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    self.misses += 1
+                    instance = _MISSING
+                    break
+                if start is None:
+                    start = perf_counter()
+                    self.waits += 1
+                loop = get_running_loop()
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            timeout = None
+            if self.timeout is not None:
+                timeout = max(0, self.timeout - (perf_counter() - start))
+            try:
+                await wait_for(waiter, timeout)
+            except AsyncTimeoutError:
+                self.wait_time += perf_counter() - start
+                raise DipyException(
+                    "Timed out waiting for a pooled instance of '%s'" % self.name) from None
+        if start is not None:
+            self.wait_time += perf_counter() - start
+        if instance is _MISSING:
+            instance = self._create(registration, *args)
+        return instance
+
+    def _create(self, registration, *args):
+        try:
+            return self.container._build_instance(registration, False, *args)
+        except Exception:
+            self._discard()
+            raise
+
+    def _discard(self):
+        with self._condition:
+            self._created -= 1
+            self._notify()
+
+    def release(self, instance):
+        # Instances that fail to reset are dropped from the pool
+        if self.reset is not None:
+            try:
+                self.reset(instance)
+            except Exception:
+                self._discard()
+                raise
+        with self._condition:
+            self._idle.append(instance)
+            self._notify()
+
+    def _notify(self):
+        # Called holding the condition. Every waiting task is woken, as any
+        # of them may have stopped waiting, and those that miss out wait again.
+        self._condition.notify()
+        waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake_waiter, waiter)
+            except RuntimeError:
+                # The waiter's event loop has been closed
+                pass
+
+    def stats(self):
+        with self._condition:
+            checkouts = self.hits + self.misses
+            return {'size': self.size, 'created': self._created, 'idle': len(self._idle),
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits) / checkouts if checkouts else 0.0,
+                    'waits': self.waits, 'wait_time': self.wait_time}
+
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _hashable(args):
+    # Unhashable arguments can't be memoized, so their instances are built
+    # and owned as though the component wasn't
+    try:
+        hash(args)
+    except TypeError:
+        return False
+    return True
+
+
+class _MemoCache(object):
+    """ An LRU cache of instances keyed by the arguments they were built
+    with. Instances are entered when added and disposed of when evicted.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                instance, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return _MISSING
+            if expires is not None and expires <= monotonic():
+                self.misses += 1
+                self._evict(key)
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return instance
+
+    def put(self, key, instance):
+        if hasattr(instance, '__enter__'):
+            instance = instance.__enter__()
+        with self._lock:
+            # Another thread may have built the same instance meanwhile
+            existing = self._entries.get(key)
+            if existing is not None:
+                self._entries.move_to_end(key)
+                _exit_evicted(instance)
+                return existing[0]
+            expires = monotonic() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (instance, expires)
+            while len(self._entries) > self.size:
+                self._evict(next(iter(self._entries)))
+        return instance
+
+    def _evict(self, key):
+        instance, expires = self._entries.pop(key)
+        self.evictions += 1
+        _exit_evicted(instance)
+
+    def clear(self):
+        with self._lock:
+            entries, self._entries = self._entries, OrderedDict()
+        errors = []
+        for instance, expires in reversed(list(entries.values())):
+            try:
+                _exit_evicted(instance)
+            except Exception as error:
+                errors.append((instance, error))
+        if errors:
+            raise DisposalError(errors)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def _exit_evicted(instance):
+    if hasattr(instance, '__exit__'):
+        instance.__exit__(None, None, None)
+
+
+class _PoolLease(object):
+    """ Returns a pooled instance to its pool when its container exits. """
+
+    __slots__ = ('pool', 'instance')
+
+    def __init__(self, pool, instance):
+        self.pool = pool
+        self.instance = instance
+
+    def __exit__(self, type, value, traceback):
+        self.pool.release(self.instance)
+
+
+class _ContextInstances(object):
+    """ The instances with a thread or task lifetime built in one thread or
+    task, along with those that need disposing.
+    """
+
+    __slots__ = ('instances', 'entries', '__weakref__')
+
+    def __init__(self):
+        self.instances = {}
+        self.entries = []
+
+    def add(self, obj):
+        if hasattr(obj, '__enter__'):
+            obj = obj.__enter__()
+        if hasattr(obj, '__exit__'):
+            self.entries.append(obj)
+        return obj
+
+    def dispose(self):
+        _dispose_context_instances(self.instances, self.entries)
+
+
+def _dispose_context_instances(instances, entries):
+    instances.clear()
+    entries[:], entries = [], list(entries)
+    errors = []
+    for instance in reversed(entries):
+        try:
+            instance.__exit__(None, None, None)
+        except Exception as error:
+            errors.append((instance, error))
+    if errors:
+        raise DisposalError(errors)
+
+
+def _exit_instance(entry, type, value, traceback):
+    if entry[3]:
+        raise DipyException(
+            "%r was entered asynchronously and must be disposed of with 'async with'"
+            % (entry[0],))
+    entry[0].__exit__(type, value, traceback)
+
+
+async def _exit_instance_async(entry, type, value, traceback, timeout):
+    if entry[3]:
+        await wait_for(entry[0].__aexit__(type, value, traceback), timeout)
+    else:
+        entry[0].__exit__(type, value, traceback)
+
+
+def _disposal_waves(entries):
+    # Group tracked instances into waves that can each be disposed of in
+    # parallel, dependents first. An instance depends on everything tracked
+    # while it was being built, and shared instances may be used by anything
+    # tracked after them.
+    # First find the dependent each instance was built for: the first one
+    # tracked after it whose build had started by then. The instances still
+    # waiting for theirs are kept on a stack, in the order they were tracked.
+    dependents = [None] * len(entries)
+    waiting = []
+    for index, entry in enumerate(entries):
+        start = entry[1]
+        while waiting and waiting[-1] >= start:
+            dependents[waiting.pop()] = index
+        waiting.append(index)
+    ranks = [0] * len(entries)
+    highest = -1
+    for index in range(len(entries) - 1, -1, -1):
+        if entries[index][2]:
+            rank = highest + 1
+        else:
+            dependent = dependents[index]
+            rank = 0 if dependent is None else ranks[dependent] + 1
+        ranks[index] = rank
+        highest = max(highest, rank)
+    waves = [[] for rank in range(highest + 1)]
+    for entry, rank in zip(entries, ranks):
+        waves[rank].append(entry)
+    return waves
+
+
+def _find_cycles(edges):
+    # Find the strongly connected components of the eager edges with
+    # Tarjan's algorithm, iteratively so deep graphs don't exhaust the
+    # stack, then trace one cycle through each
+    index, lowlink, on_stack, stack, components = {}, {}, set(), [], []
+    for root in edges:
+        if root in index:
+            continue
+        work = [(root, 0)]
+        while work:
+            key, position = work.pop()
+            if position == 0:
+                index[key] = lowlink[key] = len(index)
+                stack.append(key)
+                on_stack.add(key)
+            dependencies = [dependency for dependency, arg, eager in edges[key] if eager]
+            for offset in range(position, len(dependencies)):
+                dependency = dependencies[offset]
+                if dependency not in index:
+                    work.append((key, offset + 1))
+                    work.append((dependency, 0))
+                    break
+                if dependency in on_stack:
+                    lowlink[key] = min(lowlink[key], index[dependency])
+            else:
+                if lowlink[key] == index[key]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == key:
+                            break
+                    components.append(component)
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[key])
+    cycles = []
+    for component in components:
+        start = min(component)
+        if len(component) == 1 and not any(
+                dependency == start for dependency, arg, eager in edges[start] if eager):
+            continue
+        path, seen, key = [], {}, start
+        while key not in seen:
+            seen[key] = len(path)
+            path.append(key)
+            key = next(dependency for dependency, arg, eager in edges[key]
+                       if eager and dependency in component)
+        cycles.append(path[seen[key]:] + [key])
+    return cycles
+
+
+class RequestScope(Container):
+    """ A pooled child container, obtained from Container.request_scope.
+
+    Registrations made against a scope overlay those of its parent for the
+    lifetime of the scope only. Nothing resolved from a scope (including
+    factories) should be used after the scope has exited, since the scope
+    will be reused for another request.
+    """
+
+    __slots__ = ()
+
+    max_pooled = 32
+
+    def __exit__(self, type, value, traceback):
+        try:
+            super(RequestScope, self).__exit__(type, value, traceback)
+        finally:
+            self._reset()
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            await super(RequestScope, self).__aexit__(type, value, traceback)
+        finally:
+            self._reset()
+
+    def _reset(self):
+        del self._instances[:]
+        self._single_instances.clear()
+        self._compiled.clear()
+        if self.registry:
+            self.registry.clear()
+            self._types.clear()
+            self._tag_index.clear()
+            self._generation += 1
+            self._epoch[0] += 1
+        pool = self.parent._scope_pool
+        if len(pool) < self.max_pooled:
+            pool.append(self)
+
+
+class _CompileError(Exception):
+    pass
+
+
+class _Compiler(object):
+    """ Generates the source of a function that builds a component and its
+    whole dependency tree, mirroring Container._resolve_parsed and
+    Container._create_instance step by step.
+
+    The generated function takes the request scope as its only argument.
+    Every other container and registered object is bound as a constant.
+    """
+
+    max_nodes = 2000
+
+    def __init__(self, container):
+        self.container = container
+        self.lines = []
+        self.namespace = {'_missing': _MISSING, 'Stub': Stub, 'LazyProxy': LazyProxy}
+        self.constants = {}
+        self.variables = 0
+        self.building = set()
+        # Whether a '_list' or '_iter' is looked up in the request scope's
+        # registry, which only holds for the container compiled against
+        self.scoped = False
+
+    def compile(self, name):
+        kind, base = _parse_name(name)
+        result = self.resolve(name, kind, base, (self.container, 'scope'), False, 1)
+        function_name = 'resolve_' + ''.join(
+            ch if ch.isalnum() else '_' for ch in name)
+        source = '\n'.join(['def %s(scope):' % function_name] + self.lines +
+                           ['    return %s' % result, ''])
+        code = compile(source, '<dipy compiled %s>' % name, 'exec')
+        exec(code, self.namespace)
+        return source, self.namespace[function_name]
+
+    def constant(self, obj):
+        key = id(obj)
+        if key not in self.constants:
+            self.constants[key] = 'c%d' % len(self.constants)
+            self.namespace[self.constants[key]] = obj
+        return self.constants[key]
+
+    def variable(self):
+        self.variables += 1
+        if self.variables > self.max_nodes:
+            raise _CompileError("Component graph is too large to compile")
+        return 'v%d' % self.variables
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def resolve(self, name, kind, base, resolver, comp_owned, depth):
+        # 'resolver' is the (container, expression) that the name is
+        # resolved in, which is always the request scope for that step
+        container, expr = resolver
+        if kind == _PLAIN or kind == _TYPED:
+            if kind == _PLAIN:
+                target = container._find(name)
+            else:
+                name, target = container._find_typed(name, base)
+            if target is None:
+                if not container._autostub:
+                    raise _CompileError("Missing dependency '%s'" % name)
+                var = self.variable()
+                self.emit(depth, '%s = %s(%r)' % (var, self.constant(container._autostub), name))
+                return var
+            owner_container, registration = target
+            if registration.locally_owned:
+                owner = resolver
+            else:
+                owner = (owner_container, self.constant(owner_container))
+            return self.create(name, registration, owner, comp_owned, depth)
+        if kind == _LIST or kind == _ITER:
+            if base not in container.registry:
+                raise _CompileError("Missing dependency '%s'" % name)
+            if expr == 'scope':
+                self.scoped = True
+        if kind == _LIST:
+            items = [self.create(base, registration, resolver, comp_owned, depth)
+                     for registration in container.registry[base]]
+            var = self.variable()
+            self.emit(depth, '%s = [%s]' % (var, ', '.join(items)))
+            return var
+        if kind == _ITER:
+            var = self.variable()
+            self.emit(depth, '%s = %s._resolve_from_str(%r, %s, %r)'
+                      % (var, expr, name, expr, comp_owned))
+            return var
+        if kind == _FACT:
+            var = self.variable()
+            self.emit(depth, '%s = %s._factory(%r, %r)' % (var, expr, base, comp_owned))
+            return var
+        if kind == _LAZY:
+            var = self.variable()
+            self.emit(depth, '%s = LazyProxy(lambda: %s._resolve_from_str(%r, %s, %r))'
+                      % (var, expr, base, expr, comp_owned))
+            return var
+        if kind == _OWNED:
+            return self.resolve(base, _PLAIN, base, resolver, True, depth)
+        raise _CompileError("Invalid dependency name '%s'" % name)
+
+    def create(self, name, registration, owner, comp_owned, depth):
+        if registration.recording is not None:
+            raise _CompileError("Registration can't be compiled")
+        if not registration.single_instance:
+            return self.build(registration, owner, comp_owned, depth)
+        var = self.variable()
+        self.emit(depth, '%s = %s._single_instances.get(%r, _missing)' % (var, owner[1], name))
+        self.emit(depth, 'if %s is _missing:' % var)
+        self.emit(depth + 1, 'with %s._singleton_lock(%r):' % (owner[1], name))
+        self.emit(depth + 2, '%s = %s._single_instances.get(%r, _missing)' % (var, owner[1], name))
+        self.emit(depth + 2, 'if %s is _missing:' % var)
+        built = self.build(registration, owner, comp_owned, depth + 3)
+        self.emit(depth + 3, '%s = %s._single_instances[%r] = %s' % (var, owner[1], name, built))
+        return var
+
+    def build(self, registration, owner, comp_owned, depth):
+        registration.load()
+        obj = registration.obj
+        if registration.kind == _INSTANCE:
+            return self.constant(obj)
+        if (registration.kind == _COROUTINE or registration.lifetime is not None or
+                registration.pool is not None or registration.memoize is not None):
+            raise _CompileError("Registration can't be compiled")
+        key = (id(registration), id(owner[0]))
+        if key in self.building:
+            raise _CompileError("Dependency cycle")
+        self.building.add(key)
+        if not comp_owned:
+            start = self.variable()
+            self.emit(depth, '%s = len(%s._instances)' % (start, owner[1]))
+        if registration.kind == _TYPE:
+            plan = registration.plan
+            if plan is None:
+                plan = registration.build_plan()
+            args = ['%s=%s' % (arg, self.resolve(arg, kind, base, owner, False, depth))
+                    for arg, kind, base in plan]
+            call = '%s(%s)' % (self.constant(obj), ', '.join(args))
+        else:
+            call = '%s(%s)' % (self.constant(obj), owner[1])
+        self.building.discard(key)
+        var = self.variable()
+        if comp_owned:
+            self.emit(depth, '%s = %s' % (var, call))
+        else:
+            self.emit(depth, '%s = %s._add_instance(%s, %s, %r)'
+                      % (var, owner[1], call, start, registration.shared))
+        return var
 
 
 class DipyException(Exception):
@@ -124,51 +1884,571 @@ class DipyException(Exception):
         return self.value
 
 
+class DisposalError(DipyException):
+    """ Raised once a container has disposed of its instances, if any of
+    them failed. 'errors' lists the (instance, exception) pairs.
+    """
+
+    def __init__(self, errors):
+        super(DisposalError, self).__init__(
+            "Failed to dispose of %d instance(s): %s" %
+            (len(errors), "; ".join("%r: %s" % error for error in errors)))
+        self.errors = errors
+
+
+
+class ResolutionListener(object):
+    """ Receives notifications of a container heirarchy's activity; see
+    Container.add_listener. Override the methods of interest. Every method
+    is passed the container the event happened in, and is called on the
+    thread that caused it.
+    """
+
+    def resolve_started(self, container, name):
+        """ A component is about to be resolved by name. Resolves of a
+        suffixed name, such as a '_list', a '_fact' call or the first use of
+        a '_lazy' proxy, are notified under that name, around the resolves
+        of the components they build.
+        """
+
+    def resolve_finished(self, container, name, elapsed, error):
+        """ A component has been resolved, including its dependencies, in
+        'elapsed' seconds. 'error' is the exception raised, if any.
+        """
+
+    def instance_created(self, container, name, instance):
+        """ A new instance of a component has been built. """
+
+    def singleton_hit(self, container, name, instance):
+        """ An existing single instance has been returned. """
+
+    def instance_disposed(self, container, instance, elapsed, error):
+        """ An instance has been disposed of in 'elapsed' seconds. 'error'
+        is the exception raised, if any.
+        """
+
+
+class ResolutionMetrics(ResolutionListener):
+    """ A listener that counts resolves, created instances and single
+    instance hits per component name, along with a histogram of resolve
+    times. Add it to the root container to aggregate every container in
+    the heirarchy.
+    """
+
+    # Upper bounds, in seconds, of the resolve time histogram buckets; the
+    # histogram has one more bucket for anything slower
+    buckets = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0)
+
+    def __init__(self, buckets=None):
+        super(ResolutionMetrics, self).__init__()
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._lock = RLock()
+        self.reset()
+
+    def reset(self):
+        """ Discard everything collected so far. """
+        with self._lock:
+            self._components = {}
+            self.disposals = self.disposal_errors = 0
+            self.disposal_time = 0.0
+
+    def stats(self, name=None):
+        """ Return the statistics of the component 'name', or a dictionary
+        of the statistics of every component seen, keyed by name.
+        """
+        with self._lock:
+            if name is not None:
+                return _copy_stats(self._component(name))
+            return dict((name, _copy_stats(stats)) for name, stats in self._components.items())
+
+    def _component(self, name):
+        stats = self._components.get(name)
+        if stats is None:
+            stats = self._components[name] = {
+                'resolves': 0, 'errors': 0, 'created': 0, 'singleton_hits': 0,
+                'total_time': 0.0, 'max_time': 0.0,
+                'histogram': [0] * (len(self.buckets) + 1)}
+        return stats
+
+    def resolve_finished(self, container, name, elapsed, error):
+        with self._lock:
+            stats = self._component(name)
+            stats['resolves'] += 1
+            if error is not None:
+                stats['errors'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['histogram'][bisect_left(self.buckets, elapsed)] += 1
+
+    def instance_created(self, container, name, instance):
+        with self._lock:
+            self._component(name)['created'] += 1
+
+    def singleton_hit(self, container, name, instance):
+        with self._lock:
+            self._component(name)['singleton_hits'] += 1
+
+    def instance_disposed(self, container, instance, elapsed, error):
+        with self._lock:
+            self.disposals += 1
+            self.disposal_time += elapsed
+            if error is not None:
+                self.disposal_errors += 1
+
+
+class ResolutionTrace(ResolutionListener):
+    """ A listener that records every resolve as a span, with its name,
+    suffix kind, owning container and wall time. Nested resolves, including
+    those made through factories and lazy proxies while another component is
+    being built, appear as children of that component's span.
+
+    The trace can be saved in the Chrome trace-event format, which opens as
+    a flame chart in chrome://tracing, Perfetto or speedscope.
+    """
+
+    def __init__(self):
+        super(ResolutionTrace, self).__init__()
+        self.events = []
+        self._origin = perf_counter()
+        # The open spans of each thread and task
+        self._stack = ContextVar("dipy_trace_stack", default=())
+
+    def resolve_started(self, container, name):
+        span = {'name': name, 'cat': _KIND_NAMES[_parse_name(name)[0]], 'ph': 'X',
+                'ts': (perf_counter() - self._origin) * 1e6, 'pid': getpid(),
+                'tid': get_ident(), 'args': {'container': _container_label(container)}}
+        self._stack.set(self._stack.get() + (span,))
+
+    def resolve_finished(self, container, name, elapsed, error):
+        stack = self._stack.get()
+        if not stack:
+            return
+        span = stack[-1]
+        self._stack.set(stack[:-1])
+        # Measure with the trace's own clock, so nested spans always end
+        # within their parents
+        span['dur'] = (perf_counter() - self._origin) * 1e6 - span['ts']
+        if error is not None:
+            span['args']['error'] = str(error)
+        self.events.append(span)
+
+    def instance_created(self, container, name, instance):
+        self._mark(name, 'created')
+
+    def singleton_hit(self, container, name, instance):
+        self._mark(name, 'singleton_hit')
+
+    def _mark(self, name, flag):
+        stack = self._stack.get()
+        if stack and stack[-1]['name'] == name:
+            stack[-1]['args'][flag] = True
+
+    def trace_events(self):
+        """ Return the recorded spans as Chrome trace events, in the order
+        they started.
+        """
+        return sorted(self.events, key=lambda event: event['ts'])
+
+    def save(self, path):
+        """ Write the trace to 'path' as Chrome trace-event JSON. """
+        with open(path, 'w') as f:
+            dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+
+_KIND_NAMES = {_PLAIN: 'plain', _LIST: 'list', _ITER: 'iter', _FACT: 'fact', _LAZY: 'lazy',
+               _OWNED: 'owned', _INVALID: 'invalid'}
+
+
+def _container_label(container):
+    return "%s at 0x%x" % (type(container).__name__, id(container))
+
+
+def _copy_stats(stats):
+    stats = dict(stats)
+    stats['histogram'] = list(stats['histogram'])
+    return stats
+
+
 def container_resolved(container):
+    """ Decorate a function so that its arguments not passed by the caller
+    are resolved from a request scope of 'container'.
+
+    The scope stays open until the function returns. For coroutine
+    functions that is once the coroutine completes, and for generators and
+    async generators once the stream is exhausted or closed; their
+    arguments are resolved when the first item is requested.
+    """
     def wrap(f):
-        def call(*args, **kwargs):
-            with Container(parent=container) as request:
-                func_args, ignore_1, ignore_2, ignore_4 = getargspec(f)
-                for name in func_args[len(args):]:
-                    if name in kwargs: continue
-                    kwargs[name] = request.resolve(name)
-                return f(*args, **kwargs)
+        func_args = getargspec(f)[0]
+        if isasyncgenfunction(f):
+            async def call(*args, **kwargs):
+                async with container.request_scope() as request:
+                    for name in func_args[len(args):]:
+                        if name in kwargs: continue
+                        kwargs[name] = await request.resolve_async(name)
+                    stream = f(*args, **kwargs)
+                    try:
+                        async for item in stream:
+                            yield item
+                    finally:
+                        await stream.aclose()
+        elif iscoroutinefunction(f):
+            async def call(*args, **kwargs):
+                async with container.request_scope() as request:
+                    for name in func_args[len(args):]:
+                        if name in kwargs: continue
+                        kwargs[name] = await request.resolve_async(name)
+                    return await f(*args, **kwargs)
+        elif isgeneratorfunction(f):
+            def call(*args, **kwargs):
+                with container.request_scope() as request:
+                    for name in func_args[len(args):]:
+                        if name in kwargs: continue
+                        kwargs[name] = request.resolve(name)
+                    return (yield from f(*args, **kwargs))
+        else:
+            def call(*args, **kwargs):
+                with container.request_scope() as request:
+                    for name in func_args[len(args):]:
+                        if name in kwargs: continue
+                        kwargs[name] = request.resolve(name)
+                    return f(*args, **kwargs)
         return call
     return wrap
 
 
+class LazyProxy(object):
+    """ Stands in for a component injected through a "_lazy" dependency.
+    The component is resolved on first attribute access or call, and every
+    later use is forwarded to it.
+    """
+
+    __slots__ = ('_lazy_factory', '_lazy_target', '_lazy_lock')
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_lazy_factory', factory)
+        object.__setattr__(self, '_lazy_target', _MISSING)
+        # Each proxy has a lock of its own: a lock shared by every proxy
+        # would be held while components are built, and could be taken in
+        # the opposite order to a single instance's lock by another thread.
+        object.__setattr__(self, '_lazy_lock', RLock())
+
+    def _lazy_resolve(self):
+        target = self._lazy_target
+        if target is _MISSING:
+            with self._lazy_lock:
+                target = self._lazy_target
+                if target is _MISSING:
+                    target = self._lazy_factory()
+                    object.__setattr__(self, '_lazy_target', target)
+                    object.__setattr__(self, '_lazy_factory', None)
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_resolve(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._lazy_resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._lazy_resolve()(*args, **kwargs)
+
+    def __bool__(self):
+        return bool(self._lazy_resolve())
+
+    def __len__(self):
+        return len(self._lazy_resolve())
+
+    def __iter__(self):
+        return iter(self._lazy_resolve())
+
+    def __contains__(self, item):
+        return item in self._lazy_resolve()
+
+    def __getitem__(self, key):
+        return self._lazy_resolve()[key]
+
+    def __setitem__(self, key, value):
+        self._lazy_resolve()[key] = value
+
+    def __eq__(self, other):
+        return self._lazy_resolve() == other
+
+    def __ne__(self, other):
+        return self._lazy_resolve() != other
+
+    def __hash__(self):
+        return hash(self._lazy_resolve())
+
+    def __str__(self):
+        return str(self._lazy_resolve())
+
+    def __repr__(self):
+        if self._lazy_target is _MISSING:
+            return "<LazyProxy (unresolved)>"
+        return repr(self._lazy_target)
+
+
 class Stub(object):
-    
-    def __init__(self, name):
-        def set_attr(name, value):
-            super(Stub, self).__setattr__(name, value)
-        set_attr("stub_attrs", {})
-        set_attr("stub_name", name)
-        set_attr("call_history", [])
-        set_attr("call_count", 0)
-    
+    """ A stand-in for any object: every attribute is another stub, created
+    on first access, and calling a stub returns a new stub.
+
+    Keyword arguments, shared with the stubs it creates:
+    history -- How calls are recorded: None keeps every (args, kwargs,
+    result) in call_history, an integer keeps only that many of the most
+    recent calls, "count" only updates call_count and "off" records nothing
+    (default None)
+    reuse_result -- Return the same result stub from every call, instead of
+    a new one per call (default False)
+
+    Stubs for missing dependencies are created by Container(autostub=True);
+    to configure them, pass a function of the name instead, such as
+    autostub=lambda name: Stub(name, history="count").
+    """
+
+    __slots__ = ('stub_name', 'call_count', '_attrs', '_history', '_result', '_config',
+                 '_answers')
+
+    def __init__(self, name, history=None, reuse_result=False):
+        if not (history is None or history in ("count", "off") or
+                (type(history) is int and history > 0)):
+            raise DipyException("Unknown stub history '%s'" % (history,))
+        _init_stub(self, name, (history, reuse_result))
+
+    @classmethod
+    def from_recording(cls, path, name=None):
+        """ Return a stub that answers calls with the return values recorded
+        to 'path' by Container.register(..., record=path). Calls that were
+        recorded more than once return each recorded value in turn, then
+        keep returning the last; calls that weren't recorded return stubs,
+        with a RuntimeWarning.
+
+        Calls are matched on the repr of their arguments, so only arguments
+        with the same repr in every run can be recorded, such as numbers,
+        strings and containers of them.
+        """
+        try:
+            with open(path, 'rb') as f:
+                recording = pickle_load(f)
+        except (IOError, EOFError, UnpicklingError) as error:
+            raise DipyException("Unable to load the recording '%s': %s" % (path, error)) from error
+        stub = cls(name or path)
+        attrs = stub.stub_attrs
+        attrs.update(recording['attributes'])
+        for method, answers in recording['calls'].items():
+            child = attrs[method] = _init_stub(_new_stub(Stub), method, stub._config)
+            _set_stub_attr(child, '_answers', answers)
+        return stub
+
+    @property
+    def stub_attrs(self):
+        attrs = self._attrs
+        if attrs is None:
+            attrs = {}
+            _set_stub_attr(self, '_attrs', attrs)
+        return attrs
+
+    @property
+    def call_history(self):
+        history = self._history
+        if history is None:
+            return []
+        # The full history is returned as is, so it can be inspected live
+        return history if type(history) is list else list(history)
+
     def __getattr__(self, name):
-        if name not in self.stub_attrs:
-            self.stub_attrs[name] = Stub(name)
-        return self.stub_attrs[name]
-    
+        # Only called for names that aren't slots, i.e. stubbed attributes.
+        # Special names are left unstubbed, so protocols like __enter__ and
+        # __deepcopy__ aren't mistaken as implemented.
+        if name[:2] == '__' and name[-2:] == '__':
+            raise AttributeError(name)
+        attrs = self._attrs
+        if attrs is None:
+            attrs = {}
+            _set_stub_attr(self, '_attrs', attrs)
+        value = attrs.get(name, _MISSING)
+        if value is _MISSING:
+            value = attrs[name] = _init_stub(_new_stub(Stub), name, self._config)
+        return value
+
     def __setattr__(self, name, value):
-        self.stub_attrs[name] = value
-    
+        if name in _STUB_SLOTS:
+            _set_stub_attr(self, name, value)
+        else:
+            self.stub_attrs[name] = value
+
     def __call__(self, *args, **kwargs):
-        result = Stub(self.stub_name + "_result")
-        
+        config = self._config
+        recorded = None
+        if self._answers is not None:
+            key = _call_key(args, kwargs)
+            recorded = self._answers.get(key)
+            if recorded is None:
+                warn("No call to '%s' was recorded with %s" % (self.stub_name, key),
+                     RuntimeWarning, stacklevel=2)
+        if recorded is not None:
+            result = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+        elif config[1]:
+            result = self._result
+            if result is None:
+                result = _init_stub(_new_stub(Stub), self.stub_name + "_result", config)
+                _set_stub_attr(self, '_result', result)
+        else:
+            result = _init_stub(_new_stub(Stub), self.stub_name + "_result", config)
+
         # Update the function call stats
-        def get_attr(name):
-            return super(Stub, self).__getattribute__(name)
-        def set_attr(name, value):
-            super(Stub, self).__setattr__(name, value)
-        get_attr("call_history").append((args, kwargs, result))
-        set_attr("call_count", get_attr("call_count") + 1)
-        
+        if config[0] != "off":
+            _set_stub_attr(self, 'call_count', self.call_count + 1)
+            history = self._history
+            if history is not None:
+                history.append((args, kwargs, result))
         return result
-    
+
     def __repr__(self):
         return "<Stub instance '%s'>" % self.stub_name
 
 
+_STUB_SLOTS = frozenset(Stub.__slots__)
+_new_stub = object.__new__
+_set_stub_attr = object.__setattr__
+
+
+def _init_stub(stub, name, config):
+    # Stubs created by other stubs skip __init__, as their configuration
+    # has already been checked
+    history = config[0]
+    _set_stub_attr(stub, 'stub_name', name)
+    _set_stub_attr(stub, 'call_count', 0)
+    _set_stub_attr(stub, '_attrs', None)
+    _set_stub_attr(stub, '_history', [] if history is None else
+                   deque(maxlen=history) if type(history) is int else None)
+    _set_stub_attr(stub, '_result', None)
+    _set_stub_attr(stub, '_config', config)
+    _set_stub_attr(stub, '_answers', None)
+    return stub
+
+
+def _call_key(args, kwargs):
+    # Recorded calls are matched on the repr of their arguments, which must
+    # be the same in every run
+    return repr((args, sorted(kwargs.items())))
+
+
+class _Recording(object):
+    """ The calls and attributes recorded from the instances of one
+    component, saved when the container that registered it exits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = {}
+        self.attributes = {}
+        self._lock = RLock()
+
+    def call_key(self, method, args, kwargs):
+        """ Return the key a call is recorded under, refusing arguments such
+        as plain objects whose repr includes their address.
+        """
+        key = _call_key(args, kwargs)
+        if ' at 0x' in key:
+            raise DipyException(
+                "Unable to record the call to '%s': %s can't be matched on replay"
+                % (method, key))
+        return key
+
+    def record_call(self, method, key, result):
+        with self._lock:
+            answers = self.calls.setdefault(method, {})
+            answers.setdefault(key, []).append(result)
+
+    def record_attribute(self, name, value):
+        with self._lock:
+            self.attributes[name] = value
+
+    def save(self):
+        # Pickle before writing, and replace the file once it is complete, so
+        # an unpicklable value can't leave a truncated recording behind
+        with self._lock:
+            data = pickle_dumps({'calls': self.calls, 'attributes': self.attributes})
+        partial = self.path + '.partial'
+        with open(partial, 'wb') as f:
+            f.write(data)
+        os.replace(partial, self.path)
+
+    def __exit__(self, type, value, traceback):
+        self.save()
+
+
+class _Recorder(object):
+    """ Forwards to a component, recording the values of its attributes and
+    what its methods return.
+    """
+
+    __slots__ = ('_instance', '_recording')
+
+    def __init__(self, instance, recording):
+        object.__setattr__(self, '_instance', instance)
+        object.__setattr__(self, '_recording', recording)
+
+    def __getattr__(self, name):
+        value = getattr(self._instance, name)
+        recording = self._recording
+        if not callable(value):
+            recording.record_attribute(name, value)
+            return value
+
+        def method(*args, **kwargs):
+            key = recording.call_key(name, args, kwargs)
+            result = value(*args, **kwargs)
+            recording.record_call(name, key, result)
+            return result
+        return method
+
+    def __setattr__(self, name, value):
+        setattr(self._instance, name, value)
+
+    def __delattr__(self, name):
+        delattr(self._instance, name)
+
+    def __repr__(self):
+        return "<Recorder of %r>" % (self._instance,)
+
+
+def _recorded_enter(self):
+    entered = self._instance.__enter__()
+    return self if entered is self._instance else entered
+
+
+def _recorded_exit(self, type, value, traceback):
+    return self._instance.__exit__(type, value, traceback)
+
+
+async def _recorded_aenter(self):
+    entered = await self._instance.__aenter__()
+    return self if entered is self._instance else entered
+
+
+async def _recorded_aexit(self, type, value, traceback):
+    return await self._instance.__aexit__(type, value, traceback)
+
+
+_RECORDED_CONTEXT_METHODS = (('__enter__', _recorded_enter), ('__exit__', _recorded_exit),
+                             ('__aenter__', _recorded_aenter), ('__aexit__', _recorded_aexit))
+_recorder_classes = {}
+
+
+def _record(instance, recording):
+    """ Wrap 'instance' in a recorder with the same context manager methods,
+    so the recorder is entered, cached and disposed of in its place.
+    """
+    methods = tuple((name, method) for name, method in _RECORDED_CONTEXT_METHODS
+                    if hasattr(instance, name))
+    cls = _recorder_classes.get(methods)
+    if cls is None:
+        attrs = dict(methods, __slots__=())
+        cls = _recorder_classes.setdefault(methods, type('_Recorder', (_Recorder,), attrs))
+    return cls(instance, recording)
@@ -1,7 +1,17 @@
 #!/usr/bin/python
 
+from asyncio import Event as AsyncEvent, create_task, gather, run, sleep as async_sleep, wait_for
+from gc import collect
+from json import load
+from os import _exit, fork, path, pipe, read, waitpid, write
+from tempfile import TemporaryDirectory
+from threading import Barrier, Event, Lock, Thread
+from time import sleep
+from tracemalloc import get_traced_memory, start, stop
 from unittest import TestCase, main
-from dipy import Container, Stub, DipyException, container_resolved
+from weakref import ref
+from dipy import Container, Stub, DipyException, DisposalError, LazyProxy, container_resolved
+from dipy import ResolutionListener, ResolutionMetrics, ResolutionTrace
 
 
 #--- Tests and related classes for the IOC container
@@ -463,6 +473,1086 @@ class ContainerTests(TestCase):
         self.assertEqual(comp.widget._enter_calls, 1)
         self.assertEqual(comp.widget._exit_calls, 1)
 
+    def test_resolution_plan_is_reused(self):
+        c = Container()
+        c.register("component", ComponentWithOneDependency)
+        c.register("widget", ComponentWithNoDependencies)
+
+        # Resolve the component twice
+        c.resolve("component")
+        plan = c.registry["component"][0].plan
+        c.resolve("component")
+
+        # Verify the constructor was only inspected once
+        self.assertEqual([arg for arg, kind, base in plan], ["widget"])
+        self.assertTrue(c.registry["component"][0].plan is plan)
+
+    def test_parent_registration_invalidates_resolution_plan(self):
+        # Create a three level heirarchy with the dependency in the root
+        root = Container()
+        root.register("widget", ComponentWithNoDependencies())
+        middle = Container(parent=root)
+        child = Container(parent=middle)
+        child.register("component", ComponentWithOneDependency)
+
+        # Resolve once so the target is cached
+        comp1 = child.resolve("component")
+
+        # Override the dependency in the middle container
+        dep = ComponentWithNoDependencies()
+        middle.register("widget", dep)
+
+        # Verify the new registration is used
+        comp2 = child.resolve("component")
+        self.assertNotEqual(comp1.widget, dep)
+        self.assertEqual(comp2.widget, dep)
+
+    def test_compiled_resolution_matches_interpreted(self):
+        def build():
+            parent = Container()
+            parent.register("shared", ComponentWithGaurd, single_instance=True, locally_owned=False)
+            c = Container(parent=parent)
+            c.register("component", ComponentWithManyDependencies)
+            c.register("widget", ComponentWithGaurd)
+            c.register("widget", ComponentWithGaurd, single_instance=True)
+            c.register("helper", lambda c: ComponentWithNoDependencies())
+            return parent, c
+
+        def snapshot(parent, c):
+            with parent:
+                with c:
+                    first = c.resolve("component")
+                    second = c.resolve("component")
+                    made = first.widget_fact()
+                    during = [(w._enter_calls, w._exit_calls) for w in
+                              [first.widget, first.widget_owned, first.shared, made] +
+                              first.widget_list]
+                after = [(w._enter_calls, w._exit_calls) for w in
+                         [first.widget, first.widget_owned, first.shared, made] +
+                         first.widget_list]
+            return (type(first), type(first.helper), type(made), during, after,
+                    first.widget is second.widget,
+                    first.widget_list[0] is second.widget_list[0],
+                    first.widget_list[1] is second.widget_list[1],
+                    first.shared is second.shared,
+                    first.shared is parent.resolve("shared"))
+
+        interpreted = snapshot(*build())
+        parent, c = build()
+        self.assertRaises(DipyException, Container(parent=c).resolve, "component")
+        self.assertEqual(c.compile(), ["component", "widget", "helper"])
+        self.assertTrue("def resolve_component(scope):" in c.compiled_source("component"))
+        self.assertEqual(snapshot(parent, c), interpreted)
+
+        # A child container has no widgets of its own to list, compiled or not
+        self.assertRaises(DipyException, Container(parent=c).resolve, "component")
+
+    def test_compiled_resolution_falls_back_when_registry_changes(self):
+        c = Container()
+        c.register("component", ComponentWithOneDependency)
+        c.register("widget", ComponentWithNoDependencies)
+        c.compile()
+
+        # Override the dependency in a child container and in the parent
+        dep = ComponentWithNoDependencies()
+        child = Container(parent=c)
+        child.register("widget", dep)
+        self.assertEqual(child.resolve("component").widget, dep)
+        c.register("widget", ComponentWithArgument)
+        self.assertEqual(type(c.resolve("component").widget), ComponentWithNoDependencies)
+
+        # Components that cannot be compiled keep being interpreted
+        c.register("broken", ComponentWithListOfFactoryDependency)
+        self.assertEqual(c.compile(), ["component", "widget"])
+        self.assertEqual(c.compiled_source("broken"), None)
+
+    def test_can_resolve_through_deep_heirarchy(self):
+        # Create a four level heirarchy with the dependency in the root
+        root = Container()
+        root.register("widget", ComponentWithNoDependencies)
+        parent = Container(parent=Container(parent=root))
+        child = Container(parent=parent)
+        child.register("component", ComponentWithOneDependency)
+
+        # Resolve the component and build the parent's index
+        comp = child.resolve("component")
+        self.assertEqual(type(comp.widget), ComponentWithNoDependencies)
+        index = root._current_index()
+
+        # Registering in a child does not rebuild the parent's index
+        child.register("other", ComponentWithNoDependencies)
+        self.assertTrue(root._current_index() is index)
+        self.assertEqual(root._find("other"), None)
+        self.assertEqual(child._find("other")[0], child)
+
+        # The child's index only holds the parent names it has used
+        self.assertEqual(sorted(child._current_index()), ["component", "other"])
+        child.resolve("component")
+        self.assertEqual(sorted(child._current_index()), ["component", "other", "widget"])
+
+        # Registering in the root is visible from the child
+        root.register("missing", ComponentWithNoDependencies)
+        self.assertEqual(child._find("missing")[0], root)
+        self.assertRaises(DipyException, lambda: child.resolve("still_missing"))
+
+    def test_request_scopes_are_reused(self):
+        parent = Container()
+        parent.register("component", ComponentWithGaurd)
+
+        # Resolve a component and register an override in a scope
+        with parent.request_scope() as scope:
+            comp = scope.resolve("component")
+            scope.register("component", ComponentWithNoDependencies)
+            self.assertEqual(type(scope.resolve("component")), ComponentWithNoDependencies)
+
+        # Verify the component was disposed and the scope was reset
+        self.assertEqual(comp._exit_calls, 1)
+        with parent.request_scope() as reused:
+            self.assertTrue(reused is scope)
+            self.assertEqual(reused.registry, {})
+            self.assertEqual(type(reused.resolve("component")), ComponentWithGaurd)
+        self.assertEqual(comp._exit_calls, 1)
+
+    def test_decorated_func_disposes_request_scope(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd)
+
+        # Declare a wrapped function with a positional and a keyword argument
+        f = container_resolved(c)(lambda arg, widget: (arg, widget))
+
+        # Call the function and verify the component was disposed
+        arg, widget = f(1)
+        self.assertEqual(arg, 1)
+        self.assertEqual(widget._enter_calls, 1)
+        self.assertEqual(widget._exit_calls, 1)
+
+        # Verify explicit keyword arguments are not resolved
+        self.assertEqual(f(1, widget="explicit"), (1, "explicit"))
+
+    def test_single_instance_is_created_once_across_threads(self):
+        for compiled in (False, True):
+            c = Container()
+            c.register("component", SlowComponent, single_instance=True)
+            c.register("other", ComponentWithOneDependency)
+            c.register("widget", SlowComponent, single_instance=True)
+            if compiled:
+                c.compile()
+            SlowComponent.created = 0
+
+            # Hammer resolve from many threads at once
+            results = []
+            def worker():
+                for i in range(50):
+                    results.append(c.resolve("component"))
+                    results.append(c.resolve("other").widget)
+            threads = [Thread(target=worker) for i in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Verify exactly one instance of each was created
+            self.assertEqual(SlowComponent.created, 2)
+            self.assertEqual(len(set(map(id, results))), 2)
+
+    def test_unrelated_single_instances_are_built_concurrently(self):
+        c = Container()
+        started = Event()
+        c.register("first", lambda c: started.set() or ComponentWithNoDependencies(),
+                   single_instance=True)
+        c.register("second", lambda c: started.wait(5) and ComponentWithNoDependencies(),
+                   single_instance=True)
+
+        # Build the second single instance, which waits for the first
+        results = []
+        thread = Thread(target=lambda: results.append(c.resolve("second")))
+        thread.start()
+        sleep(0.01)
+        c.resolve("first")
+        thread.join()
+
+        # Verify the first was not blocked behind the second
+        self.assertEqual(type(results[0]), ComponentWithNoDependencies)
+
+    def test_can_warm_up_single_instances(self):
+        c = Container()
+        barrier = Barrier(2, timeout=5)
+        def build_widget(c):
+            barrier.wait()
+            return ComponentWithGaurd()
+        c.register("component", ComponentWithTwoDependencies, single_instance=True)
+        c.register("transient", ComponentWithOneDependency)
+        c.register("widget", build_widget, single_instance=True)
+        c.register("other_widget", build_widget, single_instance=True)
+
+        # Warm up the container; the two widgets must be built in parallel
+        report = c.warm_up(max_workers=2)
+
+        # Verify every single instance was built exactly once, in order
+        self.assertEqual(sorted(report), ["component", "other_widget", "widget"])
+        comp = c.resolve("component")
+        self.assertEqual(comp.transient.widget, c.resolve("widget"))
+        self.assertEqual(comp.other_widget, c.resolve("other_widget"))
+        self.assertEqual(comp.other_widget._enter_calls, 1)
+
+    def test_warm_up_fails_fast(self):
+        c = Container()
+        c.register("component", ComponentWithTwoDependencies, single_instance=True)
+        c.register("transient", ComponentWithOneDependency)
+        c.register("widget", ComponentWithArgument, single_instance=True)
+        c.register("other_widget", ComponentWithNoDependencies, single_instance=True)
+
+        # The widget needs an argument, so the component is never built
+        with self.assertRaises(DipyException) as raised:
+            c.warm_up()
+        self.assertTrue("'widget'" in str(raised.exception))
+        self.assertFalse("component" in c._single_instances)
+
+    def test_warm_up_reports_cycles(self):
+        c = Container()
+        c.register("widget", ComponentWithOneDependency, single_instance=True)
+        self.assertRaises(DipyException, c.warm_up)
+
+    def test_can_resolve_lazy_dependency(self):
+        for compiled in (False, True):
+            with Container() as c:
+                c.register("component", ComponentWithLazyDependency)
+                c.register("widget", ComponentWithGaurd)
+                if compiled:
+                    c.compile()
+
+                # Resolve the component; the dependency is not built yet
+                comp = c.resolve("component")
+                self.assertEqual(type(comp.widget_lazy), LazyProxy)
+                self.assertEqual(repr(comp.widget_lazy), "<LazyProxy (unresolved)>")
+
+                # Use the dependency and verify it was built and entered once
+                self.assertEqual(comp.widget_lazy._enter_calls, 1)
+                comp.widget_lazy.value = 1
+                self.assertEqual(comp.widget_lazy.value, 1)
+                widget = comp.widget_lazy._lazy_target
+                self.assertEqual(type(widget), ComponentWithGaurd)
+                self.assertEqual(widget._exit_calls, 0)
+
+            # Verify the container still disposes of the dependency
+            self.assertEqual(widget._exit_calls, 1)
+
+    def test_lazy_dependencies_do_not_deadlock_single_instances(self):
+        c = Container()
+        started, waiting = Event(), Event()
+        def build_widget(c):
+            started.set()
+            waiting.wait(5)
+            sleep(0.05)
+            # Use a lazy dependency while the single instance's lock is held
+            c.resolve("other_widget_lazy")._enter_calls
+            return ComponentWithGaurd()
+        c.register("component", ComponentWithLazyDependency)
+        c.register("widget", build_widget, single_instance=True)
+        c.register("other_widget", ComponentWithGaurd)
+
+        # One thread builds the widget while another resolves it lazily
+        def resolve_lazily():
+            started.wait(5)
+            comp = c.resolve("component")
+            waiting.set()
+            comp.widget_lazy._enter_calls
+        threads = [Thread(target=lambda: c.resolve("widget"), daemon=True),
+                   Thread(target=resolve_lazily, daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        # Verify neither thread was left waiting on the other
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_can_resolve_iter_dependency(self):
+        with Container() as c:
+            c.register("widget", ComponentWithNoDependencies)
+            c.register("widget", ComponentWithNoDependencies)
+            c.register("widget", ComponentWithGaurd)
+
+            # Pull the first widget only
+            widgets = c.resolve_iter("widget")
+            widget = ref(next(widgets))
+            collect()
+            self.assertEqual(widget(), None)
+            self.assertEqual(len(c._instances), 0)
+
+            # Verify the remaining widgets are built as they are pulled
+            rest = list(widgets)
+            self.assertEqual(type(rest[-1]), ComponentWithGaurd)
+            self.assertEqual(rest[-1]._enter_calls, 1)
+            self.assertEqual(len(c._instances), 1)
+
+        # Verify the pulled widget was disposed
+        self.assertEqual(rest[-1]._exit_calls, 1)
+        self.assertRaises(DipyException, lambda: c.resolve_iter("missing"))
+
+    def test_transient_instances_are_not_retained(self):
+        c = Container()
+        c.register("component", ComponentWithOneDependency)
+        c.register("widget", ComponentWithNoDependencies)
+        c.register("guarded", ComponentWithGaurd)
+
+        # Warm up, then measure memory across many resolves. A single leaked
+        # object per resolve would show up as megabytes.
+        c.resolve("component")
+        start()
+        try:
+            before = get_traced_memory()[0]
+            for i in range(50000):
+                c.resolve("component")
+            after = get_traced_memory()[0]
+        finally:
+            stop()
+
+        # Verify memory stayed flat and only disposable instances are tracked
+        self.assertTrue(after - before < 10000)
+        self.assertEqual(c._instances, [])
+        guarded = c.resolve("guarded")
+        self.assertEqual([entry[0] for entry in c._instances], [guarded])
+
+    def test_dispose_dependents_first(self):
+        for workers in (None, 4):
+            c = Container(dispose_workers=workers)
+            c.register("component", ComponentWithGuardedDependency)
+            c.register("other", ComponentWithGuardedDependency)
+            c.register("widget", ComponentWithGaurd)
+            c.register("shared", ComponentWithGaurd, single_instance=True)
+
+            # Resolve components whose dependencies also need disposing
+            with c:
+                shared = c.resolve("shared")
+                comps = [c.resolve("component"), c.resolve("other")]
+                comps.append(c.resolve("component"))
+
+            # Verify each dependency outlived its dependent
+            self.assertEqual(shared._exit_calls, 1)
+            for comp in comps:
+                self.assertEqual(comp._exit_calls, 1)
+                self.assertEqual(comp.widget._exit_calls, 1)
+                self.assertEqual(comp.widget_alive_on_exit, True)
+
+    def test_dispose_collects_errors(self):
+        c = Container()
+        c.register("failing", lambda c: FailingDisposal())
+        c.register("widget", ComponentWithGaurd)
+        widget = c.resolve("widget")
+        c.resolve("failing")
+
+        # Verify the failure is reported after every instance was disposed
+        with self.assertRaises(DisposalError) as raised:
+            with c:
+                pass
+        self.assertEqual(len(raised.exception.errors), 1)
+        self.assertEqual(type(raised.exception.errors[0][1]), ValueError)
+        self.assertEqual(widget._exit_calls, 1)
+
+    def test_dispose_in_parallel_with_timeout(self):
+        c = Container()
+        barrier = Barrier(2, timeout=5)
+        release = Event()
+        c.register("first", lambda c: CallbackDisposal(barrier.wait))
+        c.register("second", lambda c: CallbackDisposal(barrier.wait))
+        c.register("hung", lambda c: CallbackDisposal(lambda: release.wait(5)))
+        for name in ("first", "second", "hung"):
+            c.resolve(name)
+
+        # The two independent instances can only finish in parallel
+        with self.assertRaises(DisposalError) as raised:
+            c.dispose(max_workers=3, timeout=0.1)
+        release.set()
+        self.assertEqual(len(raised.exception.errors), 1)
+        self.assertTrue("Timed out" in str(raised.exception))
+
+    def test_can_resolve_async_factories_concurrently(self):
+        # The first widget can only finish once a second one has started
+        started, overlapped = [], []
+        async def build_widget(c):
+            if not overlapped:
+                overlapped.append(AsyncEvent())
+            started.append(c)
+            if len(started) == 2:
+                overlapped[0].set()
+            await wait_for(overlapped[0].wait(), 5)
+            return AsyncComponentWithGaurd()
+
+        c = Container()
+        c.register("component", ComponentWithTwoDependencies)
+        c.register("transient", ComponentWithOneDependency)
+        c.register("widget", build_widget)
+        c.register("other_widget", build_widget, single_instance=True)
+
+        async def resolve():
+            async with c:
+                comps = await gather(c.resolve_async("component"), c.resolve_async("component"))
+
+                # Verify the components were entered asynchronously
+                for comp in comps:
+                    self.assertEqual(comp.transient.widget._enter_calls, 1)
+                self.assertEqual(comps[0].other_widget, comps[1].other_widget)
+                self.assertEqual(comps[0].other_widget._enter_calls, 1)
+            return comps
+
+        # Verify the widgets were built concurrently
+        comps = run(resolve())
+        self.assertEqual(len(started), 3)
+        for comp in comps:
+            self.assertEqual(comp.transient.widget._exit_calls, 1)
+        self.assertEqual(comps[0].other_widget._exit_calls, 1)
+
+    def test_cannot_resolve_async_factory_synchronously(self):
+        async def build_widget(c):
+            return ComponentWithNoDependencies()
+
+        c = Container()
+        c.register("widget", build_widget)
+        self.assertRaises(DipyException, lambda: c.resolve("widget"))
+
+        # Resolved asynchronously, factories return coroutines
+        c.register("component", ComponentWithFactoryDependency)
+        async def resolve():
+            comp = await c.resolve_async("component")
+            return await comp.widget_fact()
+        self.assertEqual(type(run(resolve())), ComponentWithNoDependencies)
+
+    def test_cannot_dispose_async_instance_synchronously(self):
+        c = Container()
+        c.register("widget", AsyncComponentWithGaurd)
+        widget = run(c.resolve_async("widget"))
+        self.assertRaises(DisposalError, lambda: c.__exit__(None, None, None))
+        self.assertEqual(widget._exit_calls, 0)
+
+    def test_decorated_coroutine_keeps_scope_open(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd)
+
+        @container_resolved(c)
+        async def handler(widget):
+            await async_sleep(0)
+            self.assertEqual(widget._exit_calls, 0)
+            return widget
+
+        # Verify the scope closed once the coroutine completed
+        widget = run(handler())
+        self.assertEqual(widget._enter_calls, 1)
+        self.assertEqual(widget._exit_calls, 1)
+
+    def test_decorated_generator_keeps_scope_open(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd)
+
+        @container_resolved(c)
+        def handler(count, widget):
+            for i in range(count):
+                yield widget
+
+        # Verify the scope stays open while items are pulled
+        stream = handler(3)
+        items = [next(stream), next(stream)]
+        self.assertEqual(items[0]._exit_calls, 0)
+
+        # Verify the scope is closed exactly once, whether exhausted or closed
+        self.assertEqual(len(list(stream)), 1)
+        self.assertEqual(items[0]._exit_calls, 1)
+        stream = handler(3)
+        widget = next(stream)
+        stream.close()
+        self.assertEqual(widget._exit_calls, 1)
+        stream.close()
+        self.assertEqual(widget._exit_calls, 1)
+
+    def test_decorated_async_generator_keeps_scope_open(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd)
+
+        @container_resolved(c)
+        async def handler(count, widget):
+            for i in range(count):
+                await async_sleep(0)
+                yield widget
+
+        async def consume():
+            # Pull every item, then close a second stream early
+            items = []
+            async for widget in handler(3):
+                self.assertEqual(widget._exit_calls, 0)
+                items.append(widget)
+            stream = handler(3)
+            partial = await stream.__anext__()
+            await stream.aclose()
+            return items, partial
+
+        items, partial = run(consume())
+        self.assertEqual(len(items), 3)
+        self.assertEqual(items[0]._exit_calls, 1)
+        self.assertEqual(partial._exit_calls, 1)
+
+    def test_can_resolve_per_thread_instances(self):
+        with Container() as c:
+            c.register("widget", ComponentWithGaurd, lifetime="thread")
+            c.register("component", ComponentWithOneDependency)
+
+            # Resolve twice in this thread and twice in another one
+            local = [c.resolve("widget"), c.resolve("component").widget]
+            other = []
+            thread = Thread(target=lambda: other.extend(
+                [c.resolve("widget_owned"), c.resolve("widget"), c.resolve("component").widget]))
+            thread.start()
+            thread.join()
+            collect()
+
+            # Verify one instance per thread, disposed when the thread ended
+            self.assertEqual(local[0], local[1])
+            self.assertEqual(other[0], other[1])
+            self.assertEqual(other[0], other[2])
+            self.assertNotEqual(local[0], other[0])
+            self.assertEqual(other[0]._enter_calls, 1)
+            self.assertEqual(other[0]._exit_calls, 1)
+            self.assertEqual(local[0]._exit_calls, 0)
+
+        # Verify the container disposed of this thread's instance
+        self.assertEqual(local[0]._exit_calls, 1)
+
+    def test_can_resolve_per_task_instances(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd, lifetime="task")
+        c.register("transient", ComponentWithOneDependency)
+        c.register("other_widget", ComponentWithOneDependency)
+        c.register("component", ComponentWithTwoDependencies)
+
+        async def handler():
+            owned = await c.resolve_async("widget_owned")
+            comp = await c.resolve_async("component")
+            widget = c.resolve("widget")
+            self.assertEqual(owned, widget)
+            self.assertEqual(widget._enter_calls, 1)
+            self.assertEqual(comp.transient.widget, widget)
+            self.assertEqual(comp.other_widget.widget, widget)
+            return widget
+
+        async def main():
+            first, second = await gather(create_task(handler()), create_task(handler()))
+            await async_sleep(0)
+            return first, second
+
+        # Verify one instance per task, disposed when the task completed
+        first, second = run(main())
+        self.assertNotEqual(first, second)
+        self.assertEqual(first._exit_calls, 1)
+        self.assertEqual(second._exit_calls, 1)
+        self.assertRaises(DipyException, lambda: c.resolve("widget"))
+        self.assertRaises(DipyException, lambda: c.register("x", ComponentWithGaurd, lifetime="y"))
+
+    def test_can_resolve_pooled_instances(self):
+        resets = []
+        with Container() as c:
+            c.register("widget", ComponentWithGaurd, pool_size=2, pool_reset=resets.append)
+
+            # Check out two instances, then return them to the pool
+            with c.request_scope() as scope:
+                first = scope.resolve("widget")
+                second = scope.resolve("widget")
+                self.assertNotEqual(first, second)
+            self.assertEqual(sorted(map(id, resets)), sorted([id(first), id(second)]))
+
+            # Verify the instances are reused rather than disposed
+            with c.request_scope() as scope:
+                self.assertTrue(scope.resolve("widget") in (first, second))
+            self.assertEqual(first._enter_calls, 1)
+            self.assertEqual(first._exit_calls, 0)
+            stats = c.pool_stats("widget")
+            self.assertEqual((stats['created'], stats['hits'], stats['misses']), (2, 1, 2))
+
+        # Verify the pool's instances are disposed with the container
+        self.assertEqual(first._exit_calls, 1)
+        self.assertEqual(second._exit_calls, 1)
+
+    def test_exhausted_pool_waits_for_instance(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd, pool_size=1, pool_timeout=0.05)
+
+        # Time out while the only instance is checked out
+        with c.request_scope() as scope:
+            widget = scope.resolve("widget")
+            with c.request_scope() as other:
+                self.assertRaises(DipyException, lambda: other.resolve("widget"))
+
+        # Wait for the instance to be returned from another thread
+        results = []
+        def worker():
+            with c.request_scope() as other:
+                results.append(other.resolve("widget"))
+        with c.request_scope() as scope:
+            self.assertEqual(scope.resolve("widget"), widget)
+            thread = Thread(target=worker)
+            thread.start()
+            sleep(0.01)
+        thread.join()
+        self.assertEqual(results, [widget])
+        self.assertEqual(c.pool_stats("widget")['waits'], 2)
+
+    def test_exhausted_pool_wakes_waiting_tasks(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd, pool_size=1, pool_timeout=1)
+
+        async def hold(delay):
+            async with c.request_scope() as scope:
+                widget = await scope.resolve_async("widget")
+                await async_sleep(delay)
+                return widget
+
+        async def main():
+            first = create_task(hold(0.05))
+            await async_sleep(0)
+            second = await hold(0)
+            return await first, second
+
+        # Verify the waiting task is given the instance once it returns
+        first, second = run(main())
+        self.assertEqual(first, second)
+        self.assertEqual(c.pool_stats("widget")['waits'], 1)
+
+        # Verify a task that waits too long times out
+        c = Container()
+        c.register("widget", ComponentWithGaurd, pool_size=1, pool_timeout=0.01)
+        async def timeout():
+            async with c.request_scope() as scope:
+                await scope.resolve_async("widget")
+                async with c.request_scope() as other:
+                    await other.resolve_async("widget")
+        self.assertRaises(DipyException, run, timeout())
+
+    def test_can_memoize_factory_instances(self):
+        with Container() as c:
+            c.register("component", ComponentWithFactoryDependency)
+            c.register("widget", ComponentWithGaurdAndArgument, memoize=2)
+
+            # Build instances through a factory with the same arguments
+            widget_fact = c.resolve("component").widget_fact
+            first = widget_fact("a")
+            self.assertEqual(widget_fact("a"), first)
+            self.assertNotEqual(widget_fact("b"), first)
+            self.assertEqual(first._enter_calls, 1)
+
+            # Verify the least recently used instance is evicted and disposed
+            widget_fact("a")
+            widget_fact("c")
+            self.assertEqual(first._exit_calls, 0)
+            widget_fact("d")
+            self.assertEqual(first._exit_calls, 1)
+            self.assertNotEqual(widget_fact("a"), first)
+            self.assertEqual(c.memo_stats("widget"),
+                             {'size': 2, 'hits': 2, 'misses': 5, 'evictions': 3})
+            last = widget_fact("a")
+
+            # Unhashable arguments bypass the cache but are still disposed
+            unhashable = [c.resolve("widget", [1]) for _ in range(2)]
+            self.assertNotEqual(unhashable[0], unhashable[1])
+            self.assertEqual([w._enter_calls for w in unhashable], [1, 1])
+
+        # Verify the remaining instances are disposed with the container
+        self.assertEqual(last._exit_calls, 1)
+        self.assertEqual([w._exit_calls for w in unhashable], [1, 1])
+
+    def test_memoizes_each_registration_of_a_name(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd, memoize=4)
+        c.register("widget", ComponentWithNoDependencies, memoize=4)
+
+        # Verify each registration is built and cached separately
+        widgets = c.resolve("widget_list")
+        self.assertEqual([type(widget) for widget in widgets],
+                         [ComponentWithGaurd, ComponentWithNoDependencies])
+        self.assertEqual(c.resolve("widget_list"), widgets)
+        self.assertEqual(c.memo_stats("widget"),
+                         {'size': 2, 'hits': 2, 'misses': 2, 'evictions': 0})
+
+    def test_memoized_instances_expire(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurdAndArgument, memoize=10, memoize_ttl=0.01)
+        first = c.resolve("widget", "a")
+        sleep(0.02)
+        self.assertNotEqual(c.resolve("widget", "a"), first)
+        self.assertEqual(first._exit_calls, 1)
+
+    def test_factories_are_reused(self):
+        c = Container()
+        c.register("component", ComponentWithFactoryDependency)
+        c.register("widget", ComponentWithNoDependencies)
+        self.assertTrue(c.resolve("component").widget_fact is c.resolve("component").widget_fact)
+
+
+    def test_listeners_are_notified(self):
+        parent = Container()
+        listener = RecordingListener()
+        parent.add_listener(listener)
+        parent.register("widget", ComponentWithGaurd, single_instance=True, locally_owned=False)
+        with Container(parent=parent) as child:
+            child.register("component", ComponentWithOneDependency)
+            child.resolve("component")
+            child.resolve("widget")
+
+        # Verify events from the child container reach the root's listener
+        self.assertEqual([event[:2] for event in listener.events], [
+            ('resolve_started', 'component'),
+            ('resolve_started', 'widget'),
+            ('instance_created', 'widget'),
+            ('resolve_finished', 'widget'),
+            ('instance_created', 'component'),
+            ('resolve_finished', 'component'),
+            ('resolve_started', 'widget'),
+            ('singleton_hit', 'widget'),
+            ('resolve_finished', 'widget')])
+
+        # Verify disposal is reported by the owning container
+        del listener.events[:]
+        parent.__exit__(None, None, None)
+        self.assertEqual(listener.events[0][:2], ('instance_disposed', parent))
+
+        # Verify removed listeners are no longer notified
+        parent.remove_listener(listener)
+        parent.resolve("widget")
+        self.assertEqual(len(listener.events), 1)
+
+    def test_listeners_bypass_compiled_resolvers(self):
+        c = Container()
+        c.register("component", ComponentWithOneDependency)
+        c.register("widget", ComponentWithNoDependencies)
+        c.compile()
+        listener = RecordingListener()
+        c.add_listener(listener)
+        c.resolve("component")
+        self.assertEqual(len(listener.events), 6)
+
+    def test_can_collect_resolution_metrics(self):
+        parent = Container()
+        metrics = ResolutionMetrics()
+        parent.add_listener(metrics)
+        parent.register("widget", ComponentWithGaurd, single_instance=True, locally_owned=False)
+        parent.register("component", ComponentWithOneDependency)
+        for i in range(3):
+            with parent.request_scope() as scope:
+                scope.resolve("component")
+        parent.__exit__(None, None, None)
+
+        # Verify counts are aggregated from every request scope
+        stats = metrics.stats()
+        self.assertEqual(stats["component"]['resolves'], 3)
+        self.assertEqual(stats["component"]['created'], 3)
+        self.assertEqual(stats["widget"]['created'], 1)
+        self.assertEqual(stats["widget"]['singleton_hits'], 2)
+        self.assertEqual(sum(stats["widget"]['histogram']), 3)
+        self.assertEqual(metrics.disposals, 1)
+
+    def test_can_trace_resolution(self):
+        c = Container()
+        trace = ResolutionTrace()
+        c.add_listener(trace)
+        c.register("component", ComponentUsingFactory)
+        c.register("widget", ComponentWithNoDependencies, single_instance=True)
+        c.register("plugin", ComponentWithNoDependencies)
+        c.register("plugin", ComponentWithNoDependencies)
+
+        @container_resolved(c)
+        def handler(component):
+            return component
+
+        handler()
+        c.resolve("plugin_list")
+
+        # Verify the factory call is traced within the component that made it
+        component, call, widget, plugins = trace.trace_events()
+        self.assertEqual((component['name'], call['name'], widget['name'], plugins['name']),
+                         ("component", "widget_fact", "widget", "plugin_list"))
+        self.assertTrue(component['ts'] <= call['ts'] <= widget['ts'])
+        self.assertTrue(widget['ts'] + widget['dur'] <= call['ts'] + call['dur'])
+        self.assertTrue(call['ts'] + call['dur'] <= component['ts'] + component['dur'])
+        self.assertEqual((call['cat'], widget['cat'], plugins['cat']), ("fact", "plain", "list"))
+        self.assertTrue(widget['args']['created'])
+        self.assertTrue(widget['args']['container'].startswith("RequestScope"))
+
+        # Verify the trace is saved as Chrome trace-event JSON
+        with TemporaryDirectory() as directory:
+            filename = path.join(directory, "trace.json")
+            trace.save(filename)
+            with open(filename) as f:
+                events = load(f)['traceEvents']
+        self.assertEqual([event['ph'] for event in events], ['X', 'X', 'X', 'X'])
+
+        # Verify owned, lazy and iterated resolves are traced by kind
+        trace = ResolutionTrace()
+        c.add_listener(trace)
+        c.resolve("plugin_owned")
+        str(c.resolve("widget_lazy"))
+        list(c.resolve("plugin_iter"))
+        self.assertEqual([(event['name'], event['cat']) for event in trace.trace_events()],
+                         [("plugin_owned", "owned"), ("plugin", "plain"),
+                          ("widget_lazy", "lazy"), ("widget", "plain"),
+                          ("plugin_iter", "iter"), ("plugin_iter", "iter")])
+
+    def test_can_verify_without_building(self):
+        c = Container()
+        c.register("component", ComponentWithOneDependency)
+        c.register("widget", ComponentWithComponentDependency)
+        c.register("factory", ComponentWithFactoryDependency)
+        c.register("invalid", ComponentWithListOfFactoryDependency)
+        c.register("argument", ComponentWithArgument)
+        c.register("orphan", ComponentWithTwoDependencies)
+
+        # Verify missing dependencies and cycles are reported
+        report = c.verify(ignore=("arg",))
+        self.assertEqual(report['missing'], [("invalid", "widget_fact_list"),
+                                             ("orphan", "other_widget"),
+                                             ("orphan", "transient")])
+        self.assertEqual(len(report['cycles']), 1)
+        cycle = report['cycles'][0]
+        self.assertEqual(cycle[0], cycle[-1])
+        self.assertEqual(sorted(cycle[1:]), ["component", "widget"])
+        self.assertEqual(c.verify()['missing'][0], ("argument", "arg"))
+
+        # Verify nothing was built
+        self.assertEqual(c._instances, [])
+        self.assertEqual(c._single_instances, {})
+
+    def test_verify_is_linear_for_large_registries(self):
+        c = Container()
+        c.register("widget", ComponentWithNoDependencies, single_instance=True)
+        for i in range(5000):
+            c.register("component%d" % i, ComponentWithOneDependency)
+
+        # Count the lookups made rather than timing them, which is unreliable
+        lookups = []
+        find = Container._find
+        def counting_find(container, name):
+            lookups.append(name)
+            return find(container, name)
+        Container._find = counting_find
+        try:
+            report = c.verify()
+        finally:
+            Container._find = find
+
+        # Verify each dependency was looked up once
+        self.assertEqual(report, {'missing': [], 'cycles': []})
+        self.assertEqual(len(lookups), 5000)
+
+    def test_can_export_dependency_graph(self):
+        c = Container()
+        c.register("component", ComponentWithFactoryDependency)
+        c.register("widget", ComponentWithTwoDependencies, single_instance=True)
+        dot = c.to_dot()
+        self.assertTrue(dot.startswith("digraph dependencies {"))
+        self.assertTrue('[label="widget", shape=box];' in dot)
+        self.assertTrue('[label="widget_fact", style=dashed];' in dot)
+        self.assertTrue('[label="transient", color=red, fontcolor=red];' in dot)
+
+    def test_can_register_import_paths(self):
+        c = Container()
+        c.register("component", "tests:ComponentWithOneDependency", lazy_import=True)
+        c.register("widget", "tests.ComponentWithNoDependencies", lazy_import=True,
+                   single_instance=True)
+        c.register("missing", "dipy_missing_module:Component", lazy_import=True)
+
+        # Verify the import paths are imported on resolve
+        component = c.resolve("component")
+        self.assertEqual(type(component).__name__, "ComponentWithOneDependency")
+        self.assertEqual(type(component.widget).__name__, "ComponentWithNoDependencies")
+        self.assertEqual(c.resolve("widget"), component.widget)
+
+        # Verify import errors are only raised on resolve
+        self.assertRaises(DipyException, c.resolve, "missing")
+        self.assertRaises(DipyException, c.register, "widget", ComponentWithNoDependencies,
+                          lazy_import=True)
+
+    def test_can_preload_import_paths(self):
+        c = Container()
+        c.register("component", "tests:ComponentWithOneDependency", lazy_import=True)
+        c.register("missing", "dipy_missing_module:Component", lazy_import=True)
+        c.preload(background=True).join()
+
+        # Verify the class and its signature are loaded, and errors left for later
+        registration = c.registry["component"][0]
+        self.assertEqual(registration.obj.__name__, "ComponentWithOneDependency")
+        self.assertTrue(registration.plan is not None)
+        self.assertRaises(DipyException, c.preload)
+
+    def test_can_record_and_replay_components(self):
+        with TemporaryDirectory() as directory:
+            filename = path.join(directory, "service.recording")
+
+            # Record calls made to the real component
+            with Container() as c:
+                c.register("service", RemoteService, single_instance=True, record=filename)
+                service = c.resolve("service")
+                self.assertTrue(c.resolve("service") is service)
+                self.assertEqual(service.lookup(1), {"key": 1, "value": 2})
+                service.lookup(2)
+                service.lookup(2)
+                self.assertEqual(service.region, "eu")
+                self.assertEqual(c.resolve("service").calls, 3)
+
+                # Arguments that can't be matched on replay are refused
+                self.assertRaises(DipyException, service.lookup, object())
+                self.assertEqual(c.resolve("service").calls, 3)
+
+            # Verify the recorded answers are replayed by a stub
+            c = Container()
+            c.register("service", RemoteService, replay=filename)
+            fake = c.resolve("service")
+            self.assertEqual(fake.lookup(2), {"key": 2, "value": 4})
+            self.assertEqual(fake.lookup(1), {"key": 1, "value": 2})
+            self.assertEqual(fake.region, "eu")
+            self.assertEqual(fake.lookup.call_count, 2)
+            with self.assertWarns(RuntimeWarning):
+                self.assertTrue(isinstance(fake.lookup(3), Stub))
+            self.assertEqual(c._instances, [])
+
+            # Verify an unpicklable value leaves the previous recording intact
+            with self.assertRaises(DisposalError):
+                with Container() as c:
+                    c.register("service", RemoteService, record=filename)
+                    service = c.resolve("service")
+                    service.lock = Lock()
+                    service.lock
+            self.assertEqual(Stub.from_recording(filename).region, "eu")
+
+            # Verify a corrupt recording is reported
+            with open(filename, 'wb') as f:
+                f.write(b"corrupt")
+            self.assertRaises(DipyException, Stub.from_recording, filename)
+
+        self.assertRaises(DipyException, Stub.from_recording, filename)
+
+    def test_recorded_components_resolve_as_usual(self):
+        with TemporaryDirectory() as directory:
+            with Container() as c:
+                c.register("widget", ComponentWithGaurdAndArgument,
+                           record=path.join(directory, "widget.recording"))
+                c.register("plugin", ComponentWithGaurd,
+                           record=path.join(directory, "first.recording"))
+                c.register("plugin", RemoteService,
+                           record=path.join(directory, "second.recording"))
+
+                # Verify arguments and every registration of a name are kept
+                widget = c.resolve("widget", "x")
+                self.assertEqual(widget.arg, "x")
+                self.assertEqual(widget._enter_calls, 1)
+                widget.arg = "z"
+                self.assertEqual(widget._instance.arg, "z")
+                plugins = c.resolve("plugin_list")
+                self.assertEqual([type(plugin._instance) for plugin in plugins],
+                                 [ComponentWithGaurd, RemoteService])
+
+                # Verify an owned instance is left to the caller
+                owned = c.resolve("widget_owned", "y")
+                self.assertEqual(owned.arg, "y")
+                self.assertEqual(owned._enter_calls, 0)
+
+            self.assertEqual(widget._exit_calls, 1)
+            self.assertEqual(owned._exit_calls, 0)
+
+    def test_per_process_instances_are_rebuilt_after_fork(self):
+        c = Container()
+        c.register("connection", ComponentWithGaurd, single_instance=True, per_process=True)
+        c.register("config", ComponentWithNoDependencies, single_instance=True)
+        connection = c.resolve("connection")
+        config = c.resolve("config")
+
+        reader, writer = pipe()
+        pid = fork()
+        if pid == 0:
+            # In the child, only the per-process instance is rebuilt, and the
+            # parent's instance is left alone when the container exits
+            try:
+                with c:
+                    ok = (c.resolve("connection") is not connection and
+                          c.resolve("config") is config and
+                          connection._exit_calls == 0)
+                ok = ok and connection._exit_calls == 0
+                write(writer, b"1" if ok else b"0")
+            finally:
+                _exit(0)
+        waitpid(pid, 0)
+        self.assertEqual(read(reader, 1), b"1")
+        self.assertTrue(c.resolve("connection") is connection)
+        self.assertRaises(DipyException, c.register, "widget", ComponentWithGaurd,
+                          per_process=True)
+
+    def test_can_resolve_by_type(self):
+        c = Container(by_type=True)
+        c.register("sql", SqlStore)
+        c.register("repository", Repository)
+        c.register("widget", ComponentWithNoDependencies)
+
+        # Verify annotated arguments are resolved by type, including base classes
+        repository = c.resolve("repository")
+        self.assertEqual(type(repository.store), SqlStore)
+        self.assertEqual(type(repository.widget), ComponentWithNoDependencies)
+        self.assertEqual(c.verify(), {'missing': [], 'cycles': []})
+        c.compile("repository")
+        self.assertEqual(type(c.resolve("repository").store), SqlStore)
+
+        # Verify child registrations take precedence
+        child = Container(parent=c)
+        child.register("memory", MemoryStore)
+        self.assertEqual(type(child.resolve("repository").store), MemoryStore)
+
+        # Verify arguments are resolved by name unless enabled
+        c = Container()
+        c.register("sql", SqlStore)
+        c.register("repository", Repository)
+        c.register("widget", ComponentWithNoDependencies)
+        self.assertRaises(DipyException, c.resolve, "repository")
+        c.register("store", MemoryStore)
+        self.assertEqual(type(c.resolve("repository").store), MemoryStore)
+
+    def test_resolves_the_registration_of_the_annotated_type(self):
+        c = Container(by_type=True)
+        c.register("stores", MemoryStore)
+        c.register("stores", SqlStore)
+        c.register("repository", SqlRepository)
+
+        # Verify the annotated class is built, not the first of its name
+        self.assertEqual(type(c.resolve("repository").store), SqlStore)
+        self.assertEqual(type(run(c.resolve_async("repository")).store), SqlStore)
+        self.assertEqual(c.verify(), {'missing': [], 'cycles': []})
+        c.compile("repository")
+        self.assertEqual(type(c.resolve("repository").store), SqlStore)
+
+    def test_can_resolve_filtered_lists(self):
+        c = Container()
+        c.register("handler", ComponentWithArgument, tags={"region": "eu", "priority": 2})
+        c.register("handler", ComponentWithArgument, tags={"region": "us", "priority": 1})
+        c.register("handler", ComponentWithArgument, tags={"region": "eu", "priority": 1})
+        c.register("handler", ComponentWithArgument, tags={"region": "eu"})
+        c.register("handler", ComponentWithArgument)
+        metrics = ResolutionMetrics()
+        c.add_listener(metrics)
+
+        # Verify only the matching components are built
+        built = c.resolve_list("handler", "eu", where={"region": "eu"}, order_by="priority")
+        self.assertEqual([handler.arg for handler in built], ["eu", "eu", "eu"])
+        self.assertEqual(metrics.stats("handler")['created'], 3)
+        self.assertEqual(len(c.resolve_list("handler", "a", order_by="priority")), 5)
+        self.assertEqual(c.resolve_list("handler", "a", where={"region": "eu", "priority": 1})[0].arg, "a")
+        self.assertEqual(c.resolve_list("handler", where={"region": "asia"}), [])
+        self.assertRaises(DipyException, c.resolve_list, "missing")
+        self.assertRaises(DipyException, c.register, "handler", ComponentWithArgument,
+                          tags={"regions": ["eu"]})
+
+    def test_filtered_lists_are_ordered(self):
+        c = Container()
+        c.register("widget", ComponentWithGaurd, single_instance=True, tags={"priority": 2})
+        c.register("widget", ComponentWithNoDependencies, tags={"priority": 1})
+        c.register("widget", ComponentWithOneDependency)
+        widgets = c.resolve_list("widget", order_by="priority")
+        self.assertEqual([type(widget) for widget in widgets],
+                         [ComponentWithNoDependencies, ComponentWithGaurd, ComponentWithOneDependency])
+        self.assertTrue(widgets[2].widget is widgets[1])
+        self.assertEqual(c._instances[0][0]._enter_calls, 1)
 
 
 class ComponentWithNoDependencies(object):
@@ -535,6 +1625,172 @@ class ComponentWithGaurd(object):
         self._exit_calls += 1
 
 
+class ComponentWithManyDependencies(object):
+
+    def __init__(self, widget, widget_list, widget_fact, widget_owned, shared, helper):
+        super(ComponentWithManyDependencies, self).__init__()
+        self.widget = widget
+        self.widget_list = widget_list
+        self.widget_fact = widget_fact
+        self.widget_owned = widget_owned
+        self.shared = shared
+        self.helper = helper
+
+
+class SlowComponent(object):
+
+    created = 0
+    _lock = Lock()
+
+    def __init__(self):
+        super(SlowComponent, self).__init__()
+        sleep(0.01)
+        with SlowComponent._lock:
+            SlowComponent.created += 1
+
+
+class ComponentWithTwoDependencies(object):
+
+    def __init__(self, transient, other_widget):
+        super(ComponentWithTwoDependencies, self).__init__()
+        self.transient = transient
+        self.other_widget = other_widget
+
+
+class ComponentWithLazyDependency(object):
+
+    def __init__(self, widget_lazy):
+        super(ComponentWithLazyDependency, self).__init__()
+        self.widget_lazy = widget_lazy
+
+
+class ComponentWithGuardedDependency(ComponentWithGaurd):
+
+    def __init__(self, widget):
+        super(ComponentWithGuardedDependency, self).__init__()
+        self.widget = widget
+
+    def __exit__(self, type, value, traceback):
+        super(ComponentWithGuardedDependency, self).__exit__(type, value, traceback)
+        self.widget_alive_on_exit = self.widget._exit_calls == 0
+
+
+class FailingDisposal(object):
+
+    def __exit__(self, type, value, traceback):
+        raise ValueError("failed")
+
+
+class CallbackDisposal(object):
+
+    def __init__(self, callback):
+        super(CallbackDisposal, self).__init__()
+        self.callback = callback
+
+    def __exit__(self, type, value, traceback):
+        self.callback()
+
+
+class AsyncComponentWithGaurd(object):
+
+    def __init__(self):
+        super(AsyncComponentWithGaurd, self).__init__()
+        self._enter_calls = 0
+        self._exit_calls = 0
+
+    async def __aenter__(self):
+        await async_sleep(0)
+        self._enter_calls += 1
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await async_sleep(0)
+        self._exit_calls += 1
+
+
+class ComponentWithGaurdAndArgument(ComponentWithGaurd):
+
+    def __init__(self, arg):
+        super(ComponentWithGaurdAndArgument, self).__init__()
+        self.arg = arg
+
+
+class ComponentWithComponentDependency(object):
+
+    def __init__(self, component):
+        super(ComponentWithComponentDependency, self).__init__()
+        self.component = component
+
+
+class ComponentUsingFactory(object):
+
+    def __init__(self, widget_fact):
+        super(ComponentUsingFactory, self).__init__()
+        self.widget = widget_fact()
+
+
+class RemoteService(object):
+
+    region = "eu"
+
+    def __init__(self):
+        super(RemoteService, self).__init__()
+        self.calls = 0
+
+    def lookup(self, key):
+        self.calls += 1
+        return {"key": key, "value": key * 2}
+
+
+class Store(object):
+    pass
+
+
+class SqlStore(Store):
+    pass
+
+
+class MemoryStore(Store):
+    pass
+
+
+class SqlRepository(object):
+
+    def __init__(self, store: SqlStore):
+        super(SqlRepository, self).__init__()
+        self.store = store
+
+
+class Repository(object):
+
+    def __init__(self, store: Store, widget: "ComponentWithNoDependencies"):
+        super(Repository, self).__init__()
+        self.store = store
+        self.widget = widget
+
+
+class RecordingListener(ResolutionListener):
+
+    def __init__(self):
+        super(RecordingListener, self).__init__()
+        self.events = []
+
+    def resolve_started(self, container, name):
+        self.events.append(('resolve_started', name))
+
+    def resolve_finished(self, container, name, elapsed, error):
+        self.events.append(('resolve_finished', name, error))
+
+    def instance_created(self, container, name, instance):
+        self.events.append(('instance_created', name, instance))
+
+    def singleton_hit(self, container, name, instance):
+        self.events.append(('singleton_hit', name, instance))
+
+    def instance_disposed(self, container, instance, elapsed, error):
+        self.events.append(('instance_disposed', container, instance, error))
+
+
 #--- Tests for the stubing library
 
 class TestStub(TestCase):
@@ -596,6 +1852,37 @@ class TestStub(TestCase):
             m.func_mix_args.call_history[0], 
             (("one", "two"), {"last":"three"}, result_5))
 
+    def test_can_bound_call_history(self):
+        ring = Stub("ring", history=2)
+        counted = Stub("counted", history="count")
+        silent = Stub("silent", history="off")
+        for i in range(5):
+            ring.func(i)
+            counted.func(i)
+            silent.func(i)
+
+        # Verify only the configured history is kept
+        self.assertEqual([call[0] for call in ring.func.call_history], [(3,), (4,)])
+        self.assertEqual(ring.func.call_count, 5)
+        self.assertEqual(counted.func.call_history, [])
+        self.assertEqual(counted.func.call_count, 5)
+        self.assertEqual(silent.func.call_count, 0)
+        self.assertRaises(DipyException, Stub, "invalid", history="all")
+
+    def test_can_reuse_result_stubs(self):
+        m = Stub("reused", reuse_result=True)
+        self.assertTrue(m.func() is m.func())
+        self.assertTrue(m.func().other() is m.func().other())
+        self.assertFalse(self.stub.func() is self.stub.func())
+
+    def test_can_configure_autostubs(self):
+        c = Container(autostub=lambda name: Stub(name, history="count"))
+        c.register("component", ComponentWithOneDependency)
+        widget = Container(parent=c).resolve("component").widget
+        widget.func()
+        self.assertEqual(widget.stub_name, "widget")
+        self.assertEqual((widget.func.call_count, widget.func.call_history), (1, []))
+
 
 if __name__== '__main__':
     main()